@@ -1,69 +1,178 @@
 import os
-import json
-from openai import OpenAI
+import re
+import time
+import asyncio
+import operator
+import openai
 from dotenv import load_dotenv
-from serpapi import GoogleSearch
+from pydantic import BaseModel, Field, create_model
+from langgraph.types import Send, RetryPolicy
 from langgraph.graph import StateGraph, END
-from typing import TypedDict, Optional, List
+from typing import TypedDict, Optional, List, Union, Annotated, Iterator, AsyncIterator
 from langgraph.graph.state import CompiledStateGraph
-from utils import clean_search_keys, find_subject_keys
+from cache import get_search_cache, get_completion_cache, completion_key
+from checkpoints import get_checkpointer, get_async_checkpointer
+from clients import get_openai, get_async_openai, serpapi_search, aserpapi_search, run_async
+from utils import compact_search_results, truncate_tokens, chat_completion, achat_completion
+from tracing import Tracer, traced, call_span
+from pages import PAGE_FETCH_TOP_K, fetch_pages, afetch_pages
 load_dotenv(dotenv_path='.env')
 
 serpapi_key = os.environ['SERPAPI_API_KEY']
 openai_key = os.environ['OPENAI_API_KEY']
+NODE_MAX_ATTEMPTS = int(os.environ.get('NODE_MAX_ATTEMPTS', 3))
+ENTITY_SLOT = '{entity}'
+EXTRACT_FAN_IN = int(os.environ.get('EXTRACT_FAN_IN', 5)) #elements per extraction call, the groups of a batch are extracted in parallel
+EXTRACT_RESPONSE_TOKEN_BUDGET = int(os.environ.get('EXTRACT_RESPONSE_TOKEN_BUDGET', 500)) #per find_llm response, keeps every extraction call under a fixed size
+
+def _template_key(user_query : str) -> str:
+    #search templates already written for a user query are kept in the completion cache, so that a query is only enhanced once for as long as the cache holds it
+    return completion_key('query_template', [{'role' : 'user', 'content' : user_query}])
+
+#the worked example shown to extract_llm, the same for every call so that it is only built once
+EXTRACT_EXAMPLE_MESSAGES = [
+    {"role": "system", "content": """You are a helpful assistant, and given a list of information, your job
+                is to analyse each of the informations in the list, and find out the common data from each information
+                information in the list and return them as one record for each subject in the list."""},
+    {
+        "role": "user",
+        "content": """Provided the user query - \n "Find me the email and address of the headquarters for the company - {company}." , here is the list of information gathered for the same query 
+                    on various subjects - 
+
+                    ["To address the user query effectively using the provided `results`, we need to extract the keys that contain relevant information about Google's headquarters, including details about international offices and corporate contact information. Let's consolidate this information:\n\n1. **Google Headquarters Information**:\n   - **Address**: The headquarters are located at 1600 Amphitheatre Parkway, Mountain View, CA 94043, USA.\n   - **Phone Number**: You can contact the headquarters at (650) 253-0000.\n   - **Source**: This information is corroborated by multiple sources such as 'About Google' and 'corporate-office-headquarters.com'.\n\n2. **Corporate Contact Information**:\n   - **General Contact Number**: Another number for customer services available is 1-866-246-6453, which operates Monday through Friday from 9 am to 8 pm ET.\n   - **Source for Customer Support**: This is mentioned on 'PissedConsumer'.\n\n3. **International Office Details**:\n   - Google operates more than 70 offices in over 50 countries, as mentioned on 'About Google', which provides a directory of locations around the world. \n   - **Link for Locations**: More information can be found at [Google Office Locations](https://about.google/intl/ALL_us/locations/).\n\n4. **Email and Additional Support**:\n   - While specific email addresses are not provided in the search results, Google Workspace and general inquiries can be reached through [Google Cloud Contact Page](https://cloud.google.com/contact), where phone, email, and chat support are available.\n\n5. **Helpful Links**:\n   - For a broader understanding and access to more detailed contacts and office specifics, visiting [Contact Google](https://about.google/intl/ALL_us/contact-google/) is suggested.\n\nThese elements from the search results cover the primary requirements of the user query by providing the address, phone numbers, and further usability links related to Google’s headquarters and international offices.",
+                    'Here are the most relevant pieces of information gathered from the provided search results for Meta\'s headquarters contact information:\n\n1. **Physical Address**: The physical address for Meta\'s headquarters is "1 Hacker Way, Menlo Park, CA 94025-1456". This information is found in the snippet for the Better Business Bureau\'s profile on Meta Technology Company.\n\n2. **Contact Page**: \n   - The most likely official contact page can be found via the "About Meta" page, which was linked as "Offices - Meta" [about.meta.com/media-gallery/offices-around-the-world](https://about.meta.com/media-gallery/offices-around-the-world/). Although this doesn\'t explicitly list contact information, it likely allows navigation to further contact details or resources.\n   - Additionally, the Facebook Help Center page [facebook.com/help](https://www.facebook.com/help) could provide further means of assistance or contacting Meta.\n\n3. **Email Address and Phone Number**: The search results do not directly list an email address or phone number for Meta\'s headquarters. However, contacting customer service for Meta-related inquiries could be facilitated via the general Facebook customer service page as suggested by the "Facebook Customer Service Contacts" found [here](https://www.elliott.org/company-contacts/facebook/). This page mentions reaching out via phone, email, or social media, but specific contact details aren\'t provided in the snippet.\n\n4. **Additional Resources**: \n   - The Meta Investor Resources page [investor.fb.com/resources](https://investor.fb.com/resources/default.aspx) could offer further means of contacting Meta for investor-related inquiries and might provide further contact methods if necessary.\n\nFor more precise contact details such as a direct email or phone number, it\'s often best to consult these official pages or consider reaching out through the provided channels to request further specific information.',
+                    "Based on the provided search results, the most relevant information for Amazon's headquarters contact details is as follows:\n\n1. **Physical Address:**\n   - Amazon's headquarters is located at **410 Terry Ave. North, Seattle, WA, 98109-5210**. This information is mentioned in the snippet from the first search result in corporate-office-headquarters.com.\n   - Another address mentioned is **325 9th Ave. N. Seattle, WA 98109-5210**, found in the Amazon.com business notice procedures.\n   - Additionally, a separate source provides the address as **202 Westlake Ave N Ste 2, Seattle, WA 98109-5264**, according to Better Business Bureau.\n\n2. **Phone Numbers:**\n   - The main corporate phone number listed is **(206) 266-1000**.\n   - For Amazon Customer Service, the phone number is **1-888-280-4331** for US customers, and there is an international contact number, **+1 (206) 922-0880**.\n\n3. **Email Address:**\n   - The email provided for escalations in customer service is **cs-escalations@amazon.com**, as mentioned in the Elliott Report.\n   - For investor relations, the email is **amazon-ir@amazon.com**.\n\n4. **Official Contact Page:**\n   - The official Amazon contact page for customer service can be found at [Amazon Help & Customer Service](https://www.amazon.com/gp/help/customer/display.html).\n   - For investor relations, the contact page is [Amazon Investor Relations Contact Page](https://ir.aboutamazon.com/contact-us-and-request-documents/default.aspx).\n\nThese are the key contact points and addresses available from the search results that align with the user query about Amazon's headquarters."]
+                    
+                    .Analyse each data in the provided list very carefully, and compare them 
+                    against the provided user query to find a common set of information relevant to the user query, across all the data present 
+                    in the list."""
+    },
+    {
+        "role" : "assistant",
+        "content" : """First, we need to identify the main subjects present in the user query for which we should be looking out for.
+                    The user is asking for the email and address of the headquarters of the company, so these are the two pieces of information I should be looking for in the list of information present.
+                    
+                    From the first data in the list, which is about the company `Google`, we have the direct information about the address of the headquarters, 
+                    which is mentioned as `1600 Amphitheatre Parkway, Mountain View, CA 94043, USA.`
+                    As for the email, although specific information is not present, we do find relevant contact informations like [Google Cloud Contact Page](https://cloud.google.com/contact) and [Contact Google](https://about.google/intl/ALL_us/contact-google/).
+                    Apart from this, a few phone numbers have been provided, but since there isn't a direct mention of phone numbers in the user_query, we will ignore them for now.
+                    
+                    From the next data in the list, which is about the company `Meta`, we again have direct information on the address of the headquarters as mentioned in the user query, 
+                    which is `1 Hacker Way, Menlo Park, CA 94025-1456`. As for the email, we don't find any dedicated email addresses but we do find helpful contact information like [facebook.com/help](https://www.facebook.com/help), (https://www.elliott.org/company-contacts/facebook/) and (https://investor.fb.com/resources/default.aspx).
+                    We do not find any other information from this data which is relevant to the user query. 
+                    
+                    From the last data in the list, which is about the company `Amazon`, a few addresses are mentioned, but we observe that the address `410 Terry Ave. North, Seattle, WA, 98109-5210` was mentioned in the first search result, hence we will go with this one. 
+                    As for the email, we find a couple of email addresses at - cs-escalations@amazon.com and amazon-ir@amazon.com. Some other helpful links, as we found in the data for the prior companies, include - [Amazon Help & Customer Service](https://www.amazon.com/gp/help/customer/display.html). 
+                    
+                    Hence, having collected all the informations from the data present, we can format them as follows - 
+                    
+                    
+                    {
+                        "Address" : ["1600 Amphitheatre Parkway, Mountain View, CA 94043, USA.", "1 Hacker Way, Menlo Park, CA 94025-1456", "410 Terry Ave. North, Seattle, WA, 98109-5210"],
+                        "Email" : ["https://cloud.google.com/contact, https://about.google/intl/ALL_us/contact-google/", "https://www.facebook.com/help, https://www.elliott.org/company-contacts/facebook/, https://investor.fb.com/resources/default.aspx", "cs-escalations@amazon.com, amazon-ir@amazon.com"]
+                    }
+
+                    """
+    },
+]
+
+def _retry_node(exc : Exception) -> bool:
+    #requests which failed have already been retried by the scheduler, or were not worth retrying, hence running the node again would only multiply the attempts
+    #what is left is a completion which was cut short or didn't parse, which a fresh completion can fix since those are never cached
+    return isinstance(exc, (ValueError, openai.LengthFinishReasonError))
 
 class State(TypedDict):
     query : Optional[str]
-    modified_query : Optional[str]
-    search_results : Optional[dict]
-    response_list : Optional[List[str]]
-    gather_llm_response : Optional[str]
+    column_elements : Optional[List[str]] #the batch of unique elements handled by a single run of the graph
+    prompts : Optional[List[str]] #the prompts the query is made of, each is planned into a search of its own
+    query_templates : Optional[List[str]] #the enhanced search query of each prompt, with ENTITY_SLOT wherever the element goes
+    response_list : Annotated[List[tuple], operator.add] #(index, response) pairs, appended by the search branches as they finish
+    attributes : Optional[List[str]] #the attributes found for the first group of the first batch, which the rest have to stick to
+    group_records : Annotated[List[tuple], operator.add] #(group, attributes, rows) triples, appended by the extraction groups as they finish
     subject_keys : Optional[List[str]]
-    counter : Optional[int]
     final_response : Optional[dict]
 
+class ElementState(TypedDict):
+    index : int
+    element : str
+    modified_queries : List[str] #the distinct searches for the element, across every prompt
+
+class GroupState(TypedDict):
+    query : str
+    group : int
+    column_elements : List[str] #the elements of the group
+    response_list : List[str] #their find_llm responses, in the same order
+    attributes : Optional[List[str]]
+
 class SearchAgent:
-    def __init__(self, column_elements : List[str]):
-        self.llm = OpenAI()
+    def __init__(self, column_elements : List[str], max_concurrency : int = 5, bypass_cache : bool = False, batch_size : int = 10, job_id : Optional[str] = None, attributes : Optional[List[str]] = None):
+        self.llm = get_openai()
         self.column_elements = column_elements
-        self.loop_count = 0
+        self.unique_elements = [element for element in dict.fromkeys(column_elements) if element.strip()] #every distinct value is searched once, in order of first appearance, empty cells are left blank
+        self.max_concurrency = max_concurrency #upper bound on the number of search branches running at once
+        self.batch_size = batch_size #number of unique elements that go through extract_llm together
+        self.search_cache = get_search_cache()
+        self.bypass_cache = bypass_cache #skips cached search results and search templates, fresh ones are still written back to the caches
+        self.job_id = job_id #runs with a job id are checkpointed after every node, and running the same job id again resumes from there
+        self.attributes = attributes #fixes the attributes to extract, instead of having the first batch infer them from the query
+        self.tracer = None #the tracer of the current run, every node opens its span on it
         self.graph = self._create_graph()
-    
-    
+
+
     def _create_graph(self) -> CompiledStateGraph:
+        #single requests are retried by the scheduler, a node whose completion didn't parse is run again on its own, for the search node that is only the failed element's branch
+        retry = RetryPolicy(max_attempts = NODE_MAX_ATTEMPTS, retry_on = _retry_node)
         graph = StateGraph(State)
-        graph.add_node('modify_query', self._modify_query_node)
-        graph.add_node('search', self._search_node)
-        graph.add_node('find_llm', self._find_llm_node)
-        graph.add_node('gather_llm', self._gather_llm_node)
-        graph.add_node('format_llm', self._format_llm_node)
-        graph.set_entry_point("modify_query")
-        graph.add_edge('modify_query', 'search')
-        graph.add_edge('search', 'find_llm')
-        graph.add_conditional_edges('find_llm',  lambda state : 'gather_llm' if state['counter'] >= len(self.column_elements) else 'search')
-        graph.add_edge('gather_llm','format_llm')
-        graph.add_edge('format_llm', END)
-        return graph.compile()
+        graph.add_node('modify_query', self._modify_query_node, retry = retry)
+        graph.add_node('search', self._search_node, retry = retry)
+        graph.add_node('extract_group', self._extract_group_node, retry = retry)
+        graph.add_node('extract_llm', self._extract_llm_node, retry = retry)
+        graph.set_conditional_entry_point(self._route_query, ['modify_query', 'search'])
+        graph.add_conditional_edges('modify_query', self._fan_out, ['search'])
+        graph.add_edge('search', 'extract_llm')
+        graph.add_conditional_edges('extract_llm', self._route_groups, ['extract_group', END])
+        graph.add_edge('extract_group', 'extract_llm')
+        return graph.compile(checkpointer = self._checkpointer())
 
-    def _modify_query_node(self, state : State):
-        print('\033[1m\033[3m\033[36mEntering Modify Query Node...\033[0m')
-        initial_element = self.column_elements[0]
-        self.user_query = user_query = state['query']
-        if self.user_query.find('{') != -1:
-            user_query = user_query[ : user_query.find('{')] + initial_element + user_query[user_query.find('}') + 1 : ]
-        
-        state['counter'] = 0
-        state['response_list'] = []
-        completion = self.llm.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
+    def _checkpointer(self):
+        return get_checkpointer() if self.job_id is not None else None
+
+    def _query_source(self, user_query : str):
+        #the user query with its `{placeholder}` swapped for the entity slot, a query without a placeholder gets the slot at the end
+        if re.search(r'\{[^{}]*\}', user_query):
+            return re.sub(r'\{[^{}]*\}', ENTITY_SLOT, user_query)
+        return f'{user_query} - {ENTITY_SLOT}'
+
+    def _prompts(self, user_query : Union[str, List[str]]) -> List[str]:
+        if isinstance(user_query, str):
+            return [user_query]
+        return list(dict.fromkeys(query.strip() for query in user_query if query.strip()))
+
+    def _joined_query(self, prompts : List[str]) -> str:
+        #what find_llm and the extraction are asked, every attribute of every prompt is extracted together
+        if len(prompts) == 1:
+            return prompts[0]
+        return 'Find all of the following - ' + ' '.join(f'({number}) {self._query_source(prompt)}' for number, prompt in enumerate(prompts, start = 1))
+
+    def _distinct_queries(self, queries : List[str]) -> List[str]:
+        #the searches of the prompts for one element, identical ones are run once and one whose words are all part of another is covered by that one
+        words = [set(re.findall(r'\w+', query.lower())) for query in queries]
+        return [
+            query for index, query in enumerate(queries)
+            if not any(words[index] < words[other] or (words[index] == words[other] and other < index) for other in range(len(queries)))
+        ]
+
+    def _modify_query_messages(self, prompt : str):
+        return [
                 {"role": "system", "content": """You are a helpful assistant, and provided a user query which is meant for a google search, 
                 you need to restructure the query to include a broader, more inclusive set of search results. Analyse the original query and 
                 add clarifications to the generated query if needed. Include all relevant keywords in the generated query, ensuring that the generated query is optimized for Google search.
-                For product search based queries, do not suggest any specific company for it might limit the search results instead of broadening them."""},
+                For product search based queries, do not suggest any specific company for it might limit the search results instead of broadening them.
+                The query is written for a subject which is left as {entity}, keep {entity} in the generated query wherever the subject belongs, exactly as it is written, so that the query can be used for any subject.
+                When the query asks for several things, write a single search which covers all of them."""},
                 {
                     "role": "user",
-                    "content": f"""Find me the customer service emails for the following companies - Meta?"""
+                    "content": f"""Find me the customer service emails for the following companies - {ENTITY_SLOT}?"""
                 },
                 {
                     "role": "assistant",
@@ -72,205 +181,446 @@ class SearchAgent:
                     avail to customer services of the company. The query should be modified in order to accomodate customer service/helpdesk numbers, 
                     any portal leading to help, etc., along with the requested customer service email.
                     
-                    `Modified Search:`
-                    Find me the Meta customer service email, Meta customer service number, Meta helpdesk number."""
+                    `Search Template:`
+                    Find me the {ENTITY_SLOT} customer service email, {ENTITY_SLOT} customer service number, {ENTITY_SLOT} helpdesk number."""
                 },
                 {
                     "role": "user",
-                    "content": f"""Find me the best place near me from where i can get a pizza?"""
+                    "content": f"""Find me the best place near {ENTITY_SLOT} from where i can get a pizza?"""
                 },
                 {
                     "role": "assistant",
-                    "content": f"""The user is asking for a nearby place which is offering pizzas. For this, we might consider all sorts of eateries from Google maps
+                    "content": f"""The user is asking for a place near {ENTITY_SLOT} which is offering pizzas. For this, we might consider all sorts of eateries from Google maps
                     which are currently open at this hour. This can include pizzerias, restaurants, food trucks, and delivery services, along with reviews or ratings from sources like Google, Yelp, and TripAdvisor.
                     
-                    `Modified Search:`
-                    Find me the best places near me on Google maps where I can get pizza, including pizzerias, restaurants, food trucks, and delivery services which are currently open, along with reviews or ratings from sources like Google, Yelp, and TripAdvisor."""
+                    `Search Template:`
+                    Find me the best places near {ENTITY_SLOT} on Google maps where I can get pizza, including pizzerias, restaurants, food trucks, and delivery services which are currently open, along with reviews or ratings from sources like Google, Yelp, and TripAdvisor."""
                 },
                 {
                     "role": "user",
-                    "content": user_query
+                    "content": self._query_source(prompt)
                 },
-            ],
+        ]
+
+    def _parse_template(self, prompt : str, content : str) -> str:
+        template = content[content.find('Search Template:') + len('Search Template:') : ].strip('` \n') if 'Search Template:' in content else ''
+        if ENTITY_SLOT not in template: #a template without the slot would search the same thing for every element
+            template = self._query_source(prompt)
+        return template
+
+    def _cached_template(self, user_query : str) -> Optional[str]:
+        cache = get_completion_cache()
+        return cache.get(_template_key(user_query)) if cache is not None and not self.bypass_cache else None
+
+    def _cache_template(self, user_query : str, template : str):
+        cache = get_completion_cache()
+        if cache is not None:
+            cache.set(_template_key(user_query), template)
+
+    def _modify_query(self, prompt : str) -> str:
+        content = chat_completion(
+            self.llm,
+            model="gpt-4o-2024-08-06",
+            messages=self._modify_query_messages(prompt),
         )
 
-        state['modified_query'] = completion.choices[0].message.content
-        return state 
-    
-    def _search_node(self, state : State):
-        print(f'\033[1m\033[3m\033[36mEntering Search Node... {self.loop_count + 1}/{len(self.column_elements)}\033[0m')
-        if self.loop_count != 0:
-            state['modified_query'] = state['modified_query'].replace(self.column_elements[self.loop_count - 1], self.column_elements[self.loop_count])
-        else:
-            state['modified_query'] = state['modified_query'][state['modified_query'].find('Modified Search') + 18 : ]    
+        template = self._parse_template(prompt, content)
+        self._cache_template(prompt, template)
+        return template
 
-        self.loop_count += 1
-        state['counter'] += 1
-        params = {
-            "q": state['modified_query'],
+    @traced('modify_query')
+    def _modify_query_node(self, state : State):
+        #plans the search of every prompt which doesn't have a template yet
+        templates = [template or self._modify_query(prompt) for prompt, template in zip(state['prompts'], state['query_templates'])]
+        return {'query_templates' : templates}
+
+    def _route_query(self, state : State):
+        #each prompt is only enhanced once, the later batches and runs reuse its template and go straight to the searches
+        return self._fan_out(state) if all(state.get('query_templates') or [None]) else 'modify_query'
+
+    def _fan_out(self, state : State):
+        #every branch fills the entity slot of each template with its own element, and searches the distinct ones
+        return [
+            Send('search', {
+                'index' : index,
+                'element' : element,
+                'modified_queries' : self._distinct_queries([template.replace(ENTITY_SLOT, element) for template in state['query_templates']])
+            })
+            for index, element in enumerate(state['column_elements'])
+        ]
+
+    def _search_params(self, search_query : str):
+        return {
+            "q": search_query,
             "hl": "en",
             "gl": "us",
             "google_domain": "google.com",
             "api_key": serpapi_key
         }
 
-        search = GoogleSearch(params)
-        state['search_results'] = search.get_dict()
-        return state 
+    def _search(self, element : str, search_query : str) -> dict:
+        params = self._search_params(search_query)
+        with call_span('serpapi', element = element) as call:
+            search_results = self.search_cache.get(params, bypass = self.bypass_cache)
+            call.set(cache_hit = search_results is not None)
+            if search_results is None:
+                search_results = serpapi_search(params)
+                self.search_cache.set(params, search_results)
+        return search_results
 
-    def _find_llm_node(self, state : State):
-        print('\033[1m\033[3m\033[36mEntering Find LLM Node...\033[0m')
-        search_query = state['modified_query']
-        state['search_results'] = clean_search_keys(state['search_results'])
-        completion = self.llm.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
+    def _unique_pages(self, pages_per_search : List[List[dict]]) -> List[dict]:
+        #the same page can turn up in the results of more than one search
+        unique = {page['link'] : page for pages in pages_per_search for page in pages}
+        return list(unique.values())
+
+    @traced('search')
+    def _search_node(self, state : ElementState):
+        #one search per distinct query of the element, their results all go to a single find_llm
+        queries = state['modified_queries']
+        search_results = [self._search(state['element'], search_query) for search_query in queries]
+        pages = self._unique_pages([fetch_pages(results, search_query) for results, search_query in zip(search_results, queries)]) if PAGE_FETCH_TOP_K else None
+        normal_response = self._find_llm(queries, search_results, pages)
+        return {'response_list' : [(state['index'], normal_response)]}
+
+    def _find_llm_messages(self, search_queries : List[str], search_results : List[dict], pages : Optional[List[dict]] = None):
+        search_query = self._joined_query(search_queries)
+        if len(search_results) == 1:
+            search_results = compact_search_results(search_results[0])
+        else: #the results of each search, keyed by the search they came from
+            search_results = {query : compact_search_results(results) for query, results in zip(search_queries, search_results)}
+        #passages read from the pages of the top results, when page fetching is turned on
+        page_passages = f"""
+                    Here are passages read from the pages of the top results, which often hold the details left out of the snippets - `pages` - \n {pages}.""" if pages else ''
+        return [
                 {"role": "system", "content": """You are a helpful assistant, and given a python dictionary 
                 containing google search results for a certain query, your task is to obtain the most relevant informations regarding
                 the user query from the provided python dictionary."""},
                 {
                     "role": "user",
-                    "content": f"""Provided the user query - {search_query}, here is the google search results for the query - `results` - \n {state['search_results']}.
+                    "content": f"""Provided the user query - {search_query}, here is the google search results for the query - `results` - \n {search_results}.{page_passages}
                     Analyse all the keys and their values from the results, and extract out the most relevant informations from the provided `results` which best satisfies the user query {search_query}. 
                     If you are unable to find any direct information which satisfies the user query, search for any additional information, including helpful links, which might be relevant.
-                    For a reference, here is the user query again - {search_query}, and here is search results - \n {state['search_results']}"""
+                    For a reference, here is the user query again - {search_query}."""
                 }
-            ],
-        )
+        ]
 
-        normal_response = completion.choices[0].message.content
-        state['response_list'].append(normal_response)
-        return state 
-    
-    def _gather_llm_node(self, state : State):
-        print('\033[1m\033[3m\033[36mEntering Gather LLM Node...\033[0m')
-        assert len(state['response_list']) == len(self.column_elements)
-        completion = self.llm.chat.completions.create(
+    @traced('find_llm')
+    def _find_llm(self, search_queries : List[str], search_results : List[dict], pages : Optional[List[dict]] = None):
+        content = chat_completion(
+            self.llm,
             model="gpt-4o-2024-08-06",
-            messages=[
-                {"role": "system", "content": """You are a helpful assistant, and given a list of information, your job
-                is to analyse each of the informations in the list, and find out the common data from each information
-                information in the list and return them in the form of a list."""},
-                {
-                    "role": "user",
-                    "content": """Provided the user query - \n "Find me the email and address of the headquarters for the company - {company}." , here is the list of information gathered for the same query 
-                    on various subjects - 
+            messages=self._find_llm_messages(search_queries, search_results, pages),
+        )
 
-                    ["To address the user query effectively using the provided `results`, we need to extract the keys that contain relevant information about Google's headquarters, including details about international offices and corporate contact information. Let's consolidate this information:\n\n1. **Google Headquarters Information**:\n   - **Address**: The headquarters are located at 1600 Amphitheatre Parkway, Mountain View, CA 94043, USA.\n   - **Phone Number**: You can contact the headquarters at (650) 253-0000.\n   - **Source**: This information is corroborated by multiple sources such as 'About Google' and 'corporate-office-headquarters.com'.\n\n2. **Corporate Contact Information**:\n   - **General Contact Number**: Another number for customer services available is 1-866-246-6453, which operates Monday through Friday from 9 am to 8 pm ET.\n   - **Source for Customer Support**: This is mentioned on 'PissedConsumer'.\n\n3. **International Office Details**:\n   - Google operates more than 70 offices in over 50 countries, as mentioned on 'About Google', which provides a directory of locations around the world. \n   - **Link for Locations**: More information can be found at [Google Office Locations](https://about.google/intl/ALL_us/locations/).\n\n4. **Email and Additional Support**:\n   - While specific email addresses are not provided in the search results, Google Workspace and general inquiries can be reached through [Google Cloud Contact Page](https://cloud.google.com/contact), where phone, email, and chat support are available.\n\n5. **Helpful Links**:\n   - For a broader understanding and access to more detailed contacts and office specifics, visiting [Contact Google](https://about.google/intl/ALL_us/contact-google/) is suggested.\n\nThese elements from the search results cover the primary requirements of the user query by providing the address, phone numbers, and further usability links related to Google’s headquarters and international offices.",
-                    'Here are the most relevant pieces of information gathered from the provided search results for Meta\'s headquarters contact information:\n\n1. **Physical Address**: The physical address for Meta\'s headquarters is "1 Hacker Way, Menlo Park, CA 94025-1456". This information is found in the snippet for the Better Business Bureau\'s profile on Meta Technology Company.\n\n2. **Contact Page**: \n   - The most likely official contact page can be found via the "About Meta" page, which was linked as "Offices - Meta" [about.meta.com/media-gallery/offices-around-the-world](https://about.meta.com/media-gallery/offices-around-the-world/). Although this doesn\'t explicitly list contact information, it likely allows navigation to further contact details or resources.\n   - Additionally, the Facebook Help Center page [facebook.com/help](https://www.facebook.com/help) could provide further means of assistance or contacting Meta.\n\n3. **Email Address and Phone Number**: The search results do not directly list an email address or phone number for Meta\'s headquarters. However, contacting customer service for Meta-related inquiries could be facilitated via the general Facebook customer service page as suggested by the "Facebook Customer Service Contacts" found [here](https://www.elliott.org/company-contacts/facebook/). This page mentions reaching out via phone, email, or social media, but specific contact details aren\'t provided in the snippet.\n\n4. **Additional Resources**: \n   - The Meta Investor Resources page [investor.fb.com/resources](https://investor.fb.com/resources/default.aspx) could offer further means of contacting Meta for investor-related inquiries and might provide further contact methods if necessary.\n\nFor more precise contact details such as a direct email or phone number, it\'s often best to consult these official pages or consider reaching out through the provided channels to request further specific information.',
-                    "Based on the provided search results, the most relevant information for Amazon's headquarters contact details is as follows:\n\n1. **Physical Address:**\n   - Amazon's headquarters is located at **410 Terry Ave. North, Seattle, WA, 98109-5210**. This information is mentioned in the snippet from the first search result in corporate-office-headquarters.com.\n   - Another address mentioned is **325 9th Ave. N. Seattle, WA 98109-5210**, found in the Amazon.com business notice procedures.\n   - Additionally, a separate source provides the address as **202 Westlake Ave N Ste 2, Seattle, WA 98109-5264**, according to Better Business Bureau.\n\n2. **Phone Numbers:**\n   - The main corporate phone number listed is **(206) 266-1000**.\n   - For Amazon Customer Service, the phone number is **1-888-280-4331** for US customers, and there is an international contact number, **+1 (206) 922-0880**.\n\n3. **Email Address:**\n   - The email provided for escalations in customer service is **cs-escalations@amazon.com**, as mentioned in the Elliott Report.\n   - For investor relations, the email is **amazon-ir@amazon.com**.\n\n4. **Official Contact Page:**\n   - The official Amazon contact page for customer service can be found at [Amazon Help & Customer Service](https://www.amazon.com/gp/help/customer/display.html).\n   - For investor relations, the contact page is [Amazon Investor Relations Contact Page](https://ir.aboutamazon.com/contact-us-and-request-documents/default.aspx).\n\nThese are the key contact points and addresses available from the search results that align with the user query about Amazon's headquarters."]
-                    
-                    .Analyse each data in the provided list very carefully, and compare them 
-                    against the provided user query to find a common set of information relevant to the user query, across all the data present 
-                    in the list."""
-                },
-                {
-                    "role" : "assistant",
-                    "content" : """First, we need to identify the main subjects present in the user query for which we should be looking out for.
-                    The user is asking for the email and address of the headquarters of the company, so these are the two pieces of information I should be looking for in the list of information present.
-                    
-                    From the first data in the list, which is about the company `Google`, we have the direct information about the address of the headquarters, 
-                    which is mentioned as `1600 Amphitheatre Parkway, Mountain View, CA 94043, USA.`
-                    As for the email, although specific information is not present, we do find relevant contact informations like [Google Cloud Contact Page](https://cloud.google.com/contact) and [Contact Google](https://about.google/intl/ALL_us/contact-google/).
-                    Apart from this, a few phone numbers have been provided, but since there isn't a direct mention of phone numbers in the user_query, we will ignore them for now.
-                    
-                    From the next data in the list, which is about the company `Meta`, we again have direct information on the address of the headquarters as mentioned in the user query, 
-                    which is `1 Hacker Way, Menlo Park, CA 94025-1456`. As for the email, we don't find any dedicated email addresses but we do find helpful contact information like [facebook.com/help](https://www.facebook.com/help), (https://www.elliott.org/company-contacts/facebook/) and (https://investor.fb.com/resources/default.aspx).
-                    We do not find any other information from this data which is relevant to the user query. 
-                    
-                    From the last data in the list, which is about the company `Amazon`, a few addresses are mentioned, but we observe that the address `410 Terry Ave. North, Seattle, WA, 98109-5210` was mentioned in the first search result, hence we will go with this one. 
-                    As for the email, we find a couple of email addresses at - cs-escalations@amazon.com and amazon-ir@amazon.com. Some other helpful links, as we found in the data for the prior companies, include - [Amazon Help & Customer Service](https://www.amazon.com/gp/help/customer/display.html). 
-                    
-                    Hence, having collected all the informations from the data present, we can format them as follows - 
-                    
-                    
-                    {
-                        "Address" : ["1600 Amphitheatre Parkway, Mountain View, CA 94043, USA.", "1 Hacker Way, Menlo Park, CA 94025-1456", "410 Terry Ave. North, Seattle, WA, 98109-5210"],
-                        "Email" : ["https://cloud.google.com/contact, https://about.google/intl/ALL_us/contact-google/", "https://www.facebook.com/help, https://www.elliott.org/company-contacts/facebook/, https://investor.fb.com/resources/default.aspx", "cs-escalations@amazon.com, amazon-ir@amazon.com"]
-                    }
+        return content
+    
+    def _extraction_format(self, state : GroupState):
+        #one field per element of the group, so that the response has exactly one record for each of them, in order
+        #the first group also infers the attributes asked for in the query, the later groups and batches are held to the same attributes
+        if state.get('attributes') is not None:
+            record = create_model('Record', **{f'attribute_{index}' : (str, Field(description = attribute)) for index, attribute in enumerate(state['attributes'])})
+            return create_model('Extraction', **{f'element_{index}' : (record, Field(description = f'The information found for {element}')) for index, element in enumerate(state['column_elements'])})
+        return create_model(
+            'Extraction',
+            attributes = (List[str], Field(description = 'The pieces of information asked for in the user query, such as Email or Address, one for each column of the result')),
+            **{f'element_{index}' : (List[str], Field(description = f'The information found for {element}, one value for each of the attributes, in the same order')) for index, element in enumerate(state['column_elements'])}
+        )
 
-                    """
-                },
+    def _extract_llm_messages(self, state : GroupState):
+        if state.get('attributes') is not None:
+            attribute_instruction = f"Every record should hold the following attributes - {state['attributes']}."
+        else:
+            attribute_instruction = "Name the attributes which the user query asks for, and fill in every record with one value for each of them."
+        return EXTRACT_EXAMPLE_MESSAGES + [
                 {
                     "role" : "user",
-                    "content" : f"Here is the user query - {self.user_query}, and here is the list of data - {state['response_list']}"
+                    "content" : f"""Here is the user query - {state['query']}, and here is the list of data - {state['response_list']}.
+                    The data in the list is about the following subjects, in the same order - {state['column_elements']}. {attribute_instruction}
+                    Fill in one record for every subject, using an empty string for any information which could not be found for it."""
                 }
-                
-            ],
+        ]
+
+    def _group_record(self, state : GroupState, extraction : BaseModel):
+        column_elements = state['column_elements']
+        if state.get('attributes') is not None:
+            attributes = state['attributes']
+            rows = [[getattr(getattr(extraction, f'element_{index}'), f'attribute_{position}') for position in range(len(attributes))] for index in range(len(column_elements))]
+        else:
+            attributes = extraction.attributes
+            if not attributes: #every later group and batch is held to these, hence naming none is a failed extraction, which the node is run again for
+                raise ValueError('The extraction named no attributes for the query')
+            rows = [(getattr(extraction, f'element_{index}') + [''] * len(attributes))[ : len(attributes)] for index in range(len(column_elements))]
+        return {'group_records' : [(state['group'], attributes, rows)]}
+
+    def _route_groups(self, state : State):
+        #the batch is extracted in groups of EXTRACT_FAN_IN elements, all in parallel, and extract_llm joins them
+        #until the attributes are known only the first group is sent, the rest follow once it has named them
+        if state.get('final_response') is not None:
+            return END
+        responses = [truncate_tokens(response, EXTRACT_RESPONSE_TOKEN_BUDGET) for _, response in sorted(state['response_list'], key = lambda pair : pair[0])]
+        done = set(group for group, _, _ in state.get('group_records') or [])
+        starts = range(0, len(state['column_elements']), EXTRACT_FAN_IN)
+        if state.get('attributes') is None:
+            starts = starts[ : 1]
+        return [
+            Send('extract_group', {
+                'query' : state['query'],
+                'group' : start // EXTRACT_FAN_IN,
+                'column_elements' : state['column_elements'][start : start + EXTRACT_FAN_IN],
+                'response_list' : responses[start : start + EXTRACT_FAN_IN],
+                'attributes' : state.get('attributes'),
+            })
+            for start in starts if start // EXTRACT_FAN_IN not in done
+        ]
+
+    @traced('extract_group')
+    def _extract_group_node(self, state : GroupState):
+        response_format = self._extraction_format(state)
+        content = chat_completion(
+            self.llm,
+            model="gpt-4o-2024-08-06",
+            messages=self._extract_llm_messages(state),
+            response_format = response_format,
+            check = lambda content : self._group_record(state, response_format.model_validate_json(content))
         )
 
-        state['gather_llm_response'] = completion.choices[0].message.content
-        return state 
-    
-    def _format_llm_node(self, state : State):
-        print('\033[1m\033[3m\033[36mEntering Format LLM Node...\033[0m')
-        completion = self.llm.chat.completions.create(
+        return self._group_record(state, response_format.model_validate_json(content))
+
+    @traced('extract_llm')
+    def _extract_llm_node(self, state : State):
+        #runs after the searches, and after every round of extraction groups, without calling the LLM
+        if len(state['response_list']) != len(state['column_elements']):
+            raise RuntimeError(f"extract_llm got {len(state['response_list'])} search responses for a batch of {len(state['column_elements'])} elements")
+        groups = {group : (attributes, rows) for group, attributes, rows in state.get('group_records') or []}
+        if not groups:
+            return {'group_records' : []}
+        attributes = groups[0][0]
+        if len(groups) < -(-len(state['column_elements']) // EXTRACT_FAN_IN): #the first group has named the attributes, the rest of the groups are sent with them
+            return {'attributes' : attributes}
+        rows = [row for group in sorted(groups) for row in groups[group][1]]
+
+        #we want to return a dictionary where every key is an attribute, and the value to the key is the list of values found for the elements, in order
+        final_response = dict()
+        for position, attribute in enumerate(attributes):
+            if attribute not in final_response:
+                final_response[attribute] = [row[position] for row in rows]
+        return {'subject_keys' : list(final_response.keys()), 'final_response' : final_response}
+
+    def _graph_input(self, user_query : str, batch : List[str], run : dict):
+        return {'query' : user_query, 'prompts' : run['prompts'], 'column_elements' : batch, 'query_templates' : run['query_templates'], 'attributes' : run['subject_keys'] or None}
+
+    def _new_run(self, prompts : List[str], query_templates : List[Optional[str]]):
+        self.tracer = Tracer(query = self._joined_query(prompts), prompts = len(prompts), rows = len(self.column_elements), unique = len(self.unique_elements), job_id = self.job_id or '')
+        return {'start_time' : time.time(), 'records' : dict(), 'subject_keys' : list(self.attributes or []), 'prompts' : prompts, 'query_templates' : query_templates, 'replayed' : set()}
+
+    def _batches(self):
+        for batch_number, start in enumerate(range(0, len(self.unique_elements), self.batch_size)):
+            yield batch_number, self.unique_elements[start : start + self.batch_size]
+
+    def _event(self, run : dict, batch_number : int, batch : List[str], stage : str, values : dict):
+        if stage == '__metadata__': #marks the writes of a resumed step as cached, not a node of its own
+            return None
+        event = {'stage' : stage, 'batch' : batch_number, 'elapsed' : time.time() - run['start_time']}
+        if stage == 'modify_query':
+            run['query_templates'] = values['query_templates']
+            event['query_templates'] = run['query_templates']
+        elif stage == 'search':
+            index, response = values['response_list'][0]
+            if (batch_number, index) in run['replayed']: #saved before the job was interrupted, resuming streams it once more
+                return None
+            event.update({'element' : batch[index], 'response' : response})
+        elif stage == 'extract_group':
+            event['group'] = values['group_records'][0][0]
+        elif stage == 'extract_llm':
+            if values.get('final_response') is None: #the batch is still being extracted
+                return None
+            batch_records = {element : dict() for element in batch}
+            for key, key_values in values['final_response'].items():
+                if key not in run['subject_keys']:
+                    run['subject_keys'].append(key)
+                for element, value in zip(batch, key_values):
+                    batch_records[element][key] = value
+            run['records'].update(batch_records)
+            event['records'] = batch_records
+        return event
+
+    def _update_events(self, run : dict, batch_number : int, batch : List[str], update : dict):
+        #the events for one update of the graph, writes which were saved before the job was interrupted come back flagged as cached
+        cached = (update.get('__metadata__') or dict()).get('cached', False)
+        events = [self._event(run, batch_number, batch, stage, values) for stage, values in update.items()]
+        for event in events:
+            if event is not None and cached:
+                event['resumed'] = True
+        return [event for event in events if event is not None]
+
+    def _config(self, batch_number : int):
+        config = {'max_concurrency' : self.max_concurrency}
+        if self.job_id is not None:
+            config['configurable'] = {'thread_id' : f'{self.job_id}:{batch_number}'} #every batch is a thread of its own
+        return config
+
+    def _replay(self, run : dict, batch_number : int, batch : List[str], values : dict):
+        #events for the nodes of a batch which had completed before the job was interrupted
+        events = []
+        if values.get('query_templates') and not all(run['query_templates']):
+            events.append(self._event(run, batch_number, batch, 'modify_query', values))
+        for pair in values.get('response_list', []):
+            events.append(self._event(run, batch_number, batch, 'search', {'response_list' : [pair]}))
+            run['replayed'].add((batch_number, pair[0]))
+        if values.get('final_response') is not None:
+            events.append(self._event(run, batch_number, batch, 'extract_llm', values))
+        for event in events:
+            event['resumed'] = True
+        return events
+
+    def _done_event(self, run : dict):
+        records = run['records']
+        results = {key : [records.get(element, dict()).get(key, '') for element in self.column_elements] for key in run['subject_keys']}
+        return {'stage' : 'done', 'elapsed' : time.time() - run['start_time'], 'results' : results, 'summary' : self.tracer.finish()}
+
+    def stream(self, user_query : Union[str, List[str]]) -> Iterator[dict]:
+        #yields an event as soon as each node finishes, with `elapsed` counted in seconds from the start of the run
+        #search events carry the extraction for their element, extract_llm events carry the final records for their batch
+        #the last event has the stage `done` and carries the results for every row of the column, along with a summary of the time, calls and tokens spent per stage
+        #a list of prompts is run together, each is planned into its own search per element and one column per attribute asked for across all of them
+        prompts = self._prompts(user_query)
+        user_query = self._joined_query(prompts)
+        run = self._new_run(prompts, [self._cached_template(prompt) for prompt in prompts])
+        try:
+            for batch_number, batch in self._batches():
+                config = self._config(batch_number)
+                graph_input = self._graph_input(user_query, batch, run)
+                snapshot = self.graph.get_state(config) if self.job_id is not None else None
+                if snapshot is not None and snapshot.values:
+                    yield from self._replay(run, batch_number, batch, snapshot.values)
+                    if not snapshot.next: #the batch had finished
+                        continue
+                    graph_input = None #picks up from the last checkpoint
+                for update in self.graph.stream(graph_input, config = config, stream_mode = 'updates'):
+                    yield from self._update_events(run, batch_number, batch, update)
+        except GeneratorExit: #the caller stopped reading, the spans so far are exported all the same
+            self.tracer.finish()
+            raise
+        except BaseException as exc:
+            self.tracer.finish(exc)
+            raise
+
+        yield self._done_event(run)
+
+    def invoke(self, user_query : Union[str, List[str]]):
+        for event in self.stream(user_query):
+            pass
+        return event['results']
+
+class AsyncSearchAgent(SearchAgent):
+    #the same graph with async nodes, built on the process-wide AsyncOpenAI and SerpAPI clients, so that concurrent runs share keep-alive connections
+    #ainvoke and astream are meant to run on the shared event loop from clients.get_event_loop, invoke and stream do that for sync callers
+    def __init__(self, column_elements : List[str], max_concurrency : int = 5, bypass_cache : bool = False, batch_size : int = 10, job_id : Optional[str] = None, attributes : Optional[List[str]] = None):
+        super().__init__(column_elements, max_concurrency = max_concurrency, bypass_cache = bypass_cache, batch_size = batch_size, job_id = job_id, attributes = attributes)
+        self.allm = get_async_openai()
+
+    def _checkpointer(self):
+        return get_async_checkpointer() if self.job_id is not None else None
+
+    async def _amodify_query(self, prompt : str) -> str:
+        content = await achat_completion(
+            self.allm,
             model="gpt-4o-2024-08-06",
-            messages=[
-                {"role": "system", "content": """You are a helpful assistant, and given a response, your task 
-                is to format the response in a json format. """},
-                {
-                    "role": "user",
-                    "content": f"""Provided the user query - \n {self.user_query} and the relevant information about the query as - 
-                    {state['gather_llm_response']}, structure the informations relevant to the query present in the response in a JSON format. 
-                    """
-                },
-            ],
-            response_format = { "type": "json_object" }
+            messages=self._modify_query_messages(prompt),
         )
 
-        json_response = completion.choices[0].message.content
-        json_dict = json.loads(json_response)#json_dict is a dictionary with a single key, the value of which is a list of dictionaries, each dictionary in the list corresponding to each item in self.column_elements
-        keylist = [key for key in json_dict.keys()]
-        flag = 0
-        if len(keylist) == len(self.column_elements) and all(keylist[i] == self.column_elements[i] for i in range(len(keylist))):
-            information_list = json_dict
-        else:    
-            primary_key = keylist[0]
-            information_list = json_dict[primary_key] #this is a list of dictionaries 
-            flag = 1
-        #we want to return a dictionary where every key is a subject, and the value to the key is a list of retrieved information (they'll be in order)
-        state['subject_keys'] = find_subject_keys(json_response, self.user_query)
-        state["final_response"] = dict()
-        for key in state["subject_keys"]:
-            state['final_response'][key] = []
-
-        print(f'JSON dict - {json_dict}')
-        print('----------------------------------------------------')
-        print(f'Response List - {state["response_list"]}')
-        print('----------------------------------------------------')
-        print(f'Gather LLM Response - {state['gather_llm_response']}')
-        print('----------------------------------------------------')
-        print(f'Information key - {information_list}')
-        print('----------------------------------------------------')
-        print(f'Subject keys - {state['subject_keys']}')
-        print('----------------------------------------------------')
-        if flag:
-            for data in information_list:
-                print(f'Info list element as `data` - {data}')
-                print('---------------------------------------')
-                for key in state["subject_keys"]:
-                    if key in data:
-                        state['final_response'][key].append(data[key])
-                    else:
-                        state['final_response'][key].append('')
-        else:
-            for data in information_list:
-                info = information_list[data]
-                for key in state["subject_keys"]:
-                    if key in info:
-                        if isinstance(info[key], list):
-                            hold = str(info[key])[1:-1]
-                        else:
-                            hold = info[key]
-                        state['final_response'][key].append(hold)
-                    else:
-                        state['final_response'][key].append('')                        
-        
-        return state 
-
-    def invoke(self, user_query : str):
-        final_state = self.graph.invoke({'query' : user_query})
-        return final_state['final_response']
-        
-        
+        template = self._parse_template(prompt, content)
+        await asyncio.to_thread(self._cache_template, prompt, template)
+        return template
+
+    @traced('modify_query')
+    async def _modify_query_node(self, state : State):
+        missing = [prompt for prompt, template in zip(state['prompts'], state['query_templates']) if not template]
+        planned = dict(zip(missing, await asyncio.gather(*[self._amodify_query(prompt) for prompt in missing])))
+        return {'query_templates' : [template or planned[prompt] for prompt, template in zip(state['prompts'], state['query_templates'])]}
+
+    async def _asearch(self, element : str, search_query : str) -> dict:
+        #the caches are SQLite, read and written in a worker thread so that a locked or slow database doesn't hold up the shared event loop
+        params = self._search_params(search_query)
+        with call_span('serpapi', element = element) as call:
+            search_results = await asyncio.to_thread(self.search_cache.get, params, bypass = self.bypass_cache)
+            call.set(cache_hit = search_results is not None)
+            if search_results is None:
+                search_results = await aserpapi_search(params)
+                await asyncio.to_thread(self.search_cache.set, params, search_results)
+        return search_results
+
+    @traced('search')
+    async def _search_node(self, state : ElementState):
+        queries = state['modified_queries']
+        search_results = await asyncio.gather(*[self._asearch(state['element'], search_query) for search_query in queries])
+        pages = self._unique_pages(await asyncio.gather(*[afetch_pages(results, search_query) for results, search_query in zip(search_results, queries)])) if PAGE_FETCH_TOP_K else None
+        normal_response = await self._afind_llm(queries, search_results, pages)
+        return {'response_list' : [(state['index'], normal_response)]}
+
+    @traced('find_llm')
+    async def _afind_llm(self, search_queries : List[str], search_results : List[dict], pages : Optional[List[dict]] = None):
+        content = await achat_completion(
+            self.allm,
+            model="gpt-4o-2024-08-06",
+            messages=self._find_llm_messages(search_queries, search_results, pages),
+        )
+
+        return content
+
+    @traced('extract_group')
+    async def _extract_group_node(self, state : GroupState):
+        response_format = self._extraction_format(state)
+        content = await achat_completion(
+            self.allm,
+            model="gpt-4o-2024-08-06",
+            messages=self._extract_llm_messages(state),
+            response_format = response_format,
+            check = lambda content : self._group_record(state, response_format.model_validate_json(content))
+        )
+
+        return self._group_record(state, response_format.model_validate_json(content))
+
+    async def astream(self, user_query : Union[str, List[str]]) -> AsyncIterator[dict]:
+        prompts = self._prompts(user_query)
+        user_query = self._joined_query(prompts)
+        run = self._new_run(prompts, [await asyncio.to_thread(self._cached_template, prompt) for prompt in prompts])
+        try:
+            for batch_number, batch in self._batches():
+                config = self._config(batch_number)
+                graph_input = self._graph_input(user_query, batch, run)
+                snapshot = await self.graph.aget_state(config) if self.job_id is not None else None
+                if snapshot is not None and snapshot.values:
+                    for event in self._replay(run, batch_number, batch, snapshot.values):
+                        yield event
+                    if not snapshot.next:
+                        continue
+                    graph_input = None
+                async for update in self.graph.astream(graph_input, config = config, stream_mode = 'updates'):
+                    for event in self._update_events(run, batch_number, batch, update):
+                        yield event
+        except GeneratorExit:
+            self.tracer.finish()
+            raise
+        except BaseException as exc:
+            self.tracer.finish(exc)
+            raise
+
+        yield self._done_event(run)
+
+    async def ainvoke(self, user_query : Union[str, List[str]]):
+        async for event in self.astream(user_query):
+            pass
+        return event['results']
+
+    def stream(self, user_query : Union[str, List[str]]) -> Iterator[dict]:
+        #pulls the events of astream one by one off the shared event loop
+        events = self.astream(user_query)
+        while True:
+            try:
+                yield run_async(events.__anext__())
+            except StopAsyncIteration:
+                return
+
+    def invoke(self, user_query : Union[str, List[str]]):
+        return run_async(self.ainvoke(user_query))
@@ -0,0 +1,142 @@
+import os
+import csv
+import argparse
+import threading
+import pandas as pd
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from agents import SearchAgent
+
+#headless runs for files too large for the dashboard, e.g.
+#   python batch.py companies.csv --column Company --prompt "Find the headquarters and CEO of {company}" --output enriched.parquet
+#the input is only ever read in chunks, every unique value is searched once and its record is appended to a `.partial.csv` file next to the output as soon as its batch finishes
+#several --prompt options share one search per value, and every attribute they ask for gets its own column
+#running the same command again skips the values already in the partial file and extracts the same attributes for the rest
+#once every value is done the input is streamed once more and merged with the records into the output, csv or parquet going by its extension
+
+def _read_chunks(path : str, column : Optional[str], chunksize : int):
+    #values are read as strings so that they match what the dashboard searches for, empty cells are kept as empty strings
+    return pd.read_csv(path, chunksize = chunksize, dtype = str, keep_default_na = False, usecols = [column] if column else None)
+
+def partial_path(output : str) -> str:
+    return os.path.splitext(output)[0] + '.partial.csv'
+
+def load_partial(path : str, column : str, chunksize : int):
+    #the records of a previous run, along with the attributes it extracted
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return dict(), None
+    records = dict()
+    attributes = None
+    for chunk in _read_chunks(path, None, chunksize):
+        attributes = [key for key in chunk.columns if key != column]
+        for row in chunk.to_dict('records'):
+            records[row[column]] = {key : row[key] for key in attributes}
+    if attributes is None: #header only
+        attributes = [key for key in pd.read_csv(path, nrows = 0).columns if key != column]
+    return records, attributes or None
+
+def pending_values(path : str, column : str, done : set, chunksize : int) -> List[str]:
+    pending = dict() #keeps the order in which the values first appear
+    for chunk in _read_chunks(path, column, chunksize):
+        for value in chunk[column]:
+            if value.strip() and value not in done: #the agent leaves blank values out, so they would never be done
+                pending[value] = None
+    return list(pending)
+
+class PartialWriter:
+    #appends records as they arrive, shared by every worker
+    def __init__(self, path : str, column : str):
+        self.path = path
+        self.column = column
+        self.attributes = None
+        self._lock = threading.Lock()
+
+    def start(self, attributes : List[str]):
+        with self._lock:
+            self.attributes = list(attributes)
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                with open(self.path, 'w', newline = '', encoding = 'utf-8') as file:
+                    csv.writer(file).writerow([self.column] + self.attributes)
+
+    def write(self, records : dict):
+        with self._lock:
+            with open(self.path, 'a', newline = '', encoding = 'utf-8') as file:
+                writer = csv.writer(file)
+                for element, record in records.items():
+                    writer.writerow([element] + [record.get(key, '') for key in self.attributes])
+
+def run_group(group : List[str], prompt : List[str], attributes : Optional[List[str]], writer : PartialWriter, args) -> List[str]:
+    agent = SearchAgent(group, max_concurrency = args.max_concurrency, bypass_cache = args.bypass_cache, batch_size = args.batch_size, attributes = attributes)
+    for event in agent.stream(prompt):
+        if event['stage'] == 'extract_llm':
+            if writer.attributes is None: #the first batch of a fresh run decides the attributes
+                writer.start(list(event['records'].values())[0].keys() if event['records'] else [])
+            writer.write(event['records'])
+            print(f'{len(event["records"])} values done, batch {event["batch"]} of a group of {len(group)} finished at {event["elapsed"]:.1f}s')
+    return group
+
+def enrich(args):
+    column = args.column
+    partial = partial_path(args.output)
+    records, attributes = load_partial(partial, column, args.chunksize)
+    pending = pending_values(args.input, column, set(records), args.chunksize)
+    print(f'{len(records)} values already done, {len(pending)} left to search')
+
+    writer = PartialWriter(partial, column)
+    if attributes is not None:
+        writer.start(attributes)
+    if pending and attributes is None:
+        #the first batch runs on its own so that every worker after it extracts the same attributes
+        run_group(pending[ : args.batch_size], args.prompt, None, writer, args)
+        attributes = writer.attributes
+        pending = pending[args.batch_size : ]
+    groups = [pending[start : start + args.group_size] for start in range(0, len(pending), args.group_size)]
+    with ThreadPoolExecutor(max_workers = args.workers) as executor:
+        futures = [executor.submit(run_group, group, args.prompt, attributes, writer, args) for group in groups]
+        for done, future in enumerate(as_completed(futures), start = 1):
+            future.result()
+            print(f'{done} of {len(futures)} groups done')
+
+    write_output(args.input, args.output, partial, column, args.chunksize)
+
+def write_output(input_path : str, output : str, partial : str, column : str, chunksize : int):
+    records, attributes = load_partial(partial, column, chunksize)
+    attributes = attributes or []
+    parquet = output.endswith('.parquet')
+    if parquet:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('Writing parquet needs pyarrow, install it with `pip install pyarrow` or write a .csv instead')
+    parquet_writer = None
+    for number, chunk in enumerate(_read_chunks(input_path, None, chunksize)):
+        for key in attributes:
+            chunk[key if key not in chunk.columns else f'{key} ({column})'] = [records.get(value, dict()).get(key, '') for value in chunk[column]]
+        if parquet:
+            table = pyarrow.Table.from_pandas(chunk, preserve_index = False)
+            if parquet_writer is None:
+                parquet_writer = pyarrow.parquet.ParquetWriter(output, table.schema)
+            parquet_writer.write_table(table)
+        else:
+            chunk.to_csv(output, mode = 'w' if number == 0 else 'a', header = number == 0, index = False)
+    if parquet_writer is not None:
+        parquet_writer.close()
+    print(f'Wrote {output}')
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'Searches every unique value of a CSV column and writes the extracted attributes next to it.')
+    parser.add_argument('input', help = 'the CSV file to enrich')
+    parser.add_argument('--column', required = True, help = 'the column whose values are searched')
+    parser.add_argument('--prompt', required = True, action = 'append', help = 'the query, with `{placeholder}` standing in for the values of the column, repeat it to ask several queries over one search per value')
+    parser.add_argument('--output', required = True, help = 'a .csv or .parquet file, a .partial.csv file next to it keeps the progress of the run')
+    parser.add_argument('--workers', type = int, default = 4, help = 'groups of values searched at the same time')
+    parser.add_argument('--group-size', type = int, default = 100, help = 'unique values handed to a worker at a time')
+    parser.add_argument('--batch-size', type = int, default = 10, help = 'unique values extracted per LLM call')
+    parser.add_argument('--max-concurrency', type = int, default = 5, help = 'searches in flight per worker')
+    parser.add_argument('--chunksize', type = int, default = 10000, help = 'rows read from the input at a time')
+    parser.add_argument('--bypass-cache', action = 'store_true', help = 'search again even for values in the search cache')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    enrich(parse_args())
@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import glob
+import time
+import httpx
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime
+
+#runs SearchAgent end to end against local stand-ins for SerpAPI and OpenAI, so that changes to the agent can be measured without spending any quota
+#   python benchmark.py --sizes 5 50 500 --serpapi-latency 0.3 --openai-latency 0.8 --error-rate 0.02
+#the stand-ins sit at the transport level of the pooled httpx clients, hence everything above them (scheduler, caches, parsing of structured outputs) runs as it would live
+#the environment is set up before the agent is imported, the keys are dummies and the caches live in a temporary directory so that every run starts cold
+#the directory is removed again when the process exits
+_benchmark_dir = tempfile.TemporaryDirectory(prefix = 'seeker-benchmark-', ignore_cleanup_errors = True)
+BENCHMARK_DIR = _benchmark_dir.name
+os.environ.setdefault('SERPAPI_API_KEY', 'benchmark')
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+os.environ['SEARCH_CACHE_PATH'] = os.path.join(BENCHMARK_DIR, 'search_cache.sqlite')
+os.environ['PAGE_CACHE_PATH'] = os.path.join(BENCHMARK_DIR, 'page_cache.sqlite')
+os.environ['TRACE_LOG_PATH'] = os.path.join(BENCHMARK_DIR, 'traces.jsonl')
+os.environ['COMPLETION_CACHE'] = 'off'
+os.environ['CHECKPOINT_PATH'] = os.path.join(BENCHMARK_DIR, 'checkpoints.sqlite')
+#the rate limits are lifted unless they are set explicitly, so that the numbers show the agent rather than the quota
+os.environ.setdefault('OPENAI_REQUESTS_PER_MINUTE', '1000000')
+os.environ.setdefault('OPENAI_BURST', '1000')
+os.environ.setdefault('SERPAPI_REQUESTS_PER_MINUTE', '1000000')
+os.environ.setdefault('SERPAPI_BURST', '1000')
+os.environ.setdefault('BACKOFF_BASE', '0.1')
+
+import clients
+from openai import OpenAI, AsyncOpenAI
+from agents import SearchAgent, AsyncSearchAgent
+from scheduler import get_scheduler
+from cache import get_completion_cache
+from utils import count_tokens
+
+class FakeServices:
+    #answers SerpAPI and OpenAI requests with recorded or canned payloads, after the injected latency, failing some of them on purpose
+    def __init__(self, serpapi_latency : float, openai_latency : float, error_rate : float, payloads : list, seed : int = 0):
+        self.serpapi_latency = serpapi_latency
+        self.openai_latency = openai_latency
+        self.error_rate = error_rate
+        self.payloads = payloads
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {'serpapi' : 0, 'openai' : 0}
+            self.errors = {'serpapi' : 0, 'openai' : 0}
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+    def _latency(self, mean : float) -> float:
+        with self._lock:
+            return mean * self.random.uniform(0.5, 1.5)
+
+    def _fails(self, provider : str) -> bool:
+        with self._lock:
+            self.calls[provider] += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors[provider] += 1
+            return failed
+
+    def _serpapi_payload(self, query : str) -> dict:
+        if self.payloads:
+            payload = json.loads(json.dumps(self.payloads[self.calls['serpapi'] % len(self.payloads)]))
+            payload.setdefault('search_parameters', dict())['q'] = query
+            return payload
+        return {
+            'search_metadata' : {'id' : 'benchmark', 'status' : 'Success', 'total_time_taken' : self.serpapi_latency},
+            'search_parameters' : {'engine' : 'google', 'q' : query, 'google_domain' : 'google.com', 'hl' : 'en', 'gl' : 'us'},
+            'search_information' : {'total_results' : 1000000, 'time_taken_displayed' : 0.4},
+            'knowledge_graph' : {'title' : query, 'type' : 'Company', 'description' : f'{query} is a company. ' * 5, 'headquarters' : '1 Main Street, Springfield', 'website' : 'https://example.com', 'header_images' : [{'image' : 'https://example.com/image.png'}]},
+            'organic_results' : [
+                {'position' : position, 'title' : f'{query} - result {position}', 'link' : f'https://example.com/{position}', 'displayed_link' : f'example.com > {position}', 'thumbnail' : 'https://example.com/thumbnail.png', 'snippet' : f'Contact {query} at contact@example.com or visit 1 Main Street, Springfield. ' * 3, 'sitelinks' : {'inline' : [{'title' : 'About', 'link' : 'https://example.com/about'}]}}
+                for position in range(1, 11)
+            ],
+            'related_searches' : [{'query' : f'{query} {word}', 'link' : 'https://example.com'} for word in ['email', 'address', 'phone', 'careers']],
+            'pagination' : {'current' : 1, 'next' : 'https://example.com/next'},
+        }
+
+    def _instance(self, schema : dict, definitions : dict, description : str = ''):
+        #a value which validates against the json schema of a structured output
+        if '$ref' in schema:
+            return self._instance(definitions[schema['$ref'].split('/')[-1]], definitions, description)
+        if schema.get('type') == 'object':
+            return {key : self._instance(value, definitions, value.get('description', key)) for key, value in schema.get('properties', dict()).items()}
+        if schema.get('type') == 'array':
+            if 'attributes' in description.lower() or 'pieces of information' in description.lower():
+                return ['Email', 'Address']
+            return [f'{description[-20:]} value {index}' for index in range(2)]
+        return f'{description[-40:]} value'
+
+    def _completion(self, request : dict) -> dict:
+        messages = request['messages']
+        response_format = request.get('response_format')
+        if response_format and response_format.get('type') == 'json_schema':
+            schema = response_format['json_schema']['schema']
+            content = json.dumps(self._instance(schema, schema.get('$defs', dict())))
+        elif any('Search Template' in str(message['content']) for message in messages):
+            content = f"Here is the search template.\n`Search Template:` {messages[-1]['content']}"
+        else:
+            content = 'The most relevant information found is the address 1 Main Street, Springfield and the email contact@example.com. ' * 4
+        prompt_tokens = sum(count_tokens(str(message['content'])) for message in messages)
+        completion_tokens = count_tokens(content)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        return {
+            'id' : 'chatcmpl-benchmark', 'object' : 'chat.completion', 'created' : int(time.time()), 'model' : request['model'],
+            'choices' : [{'index' : 0, 'message' : {'role' : 'assistant', 'content' : content, 'refusal' : None}, 'logprobs' : None, 'finish_reason' : 'stop'}],
+            'usage' : {'prompt_tokens' : prompt_tokens, 'completion_tokens' : completion_tokens, 'total_tokens' : prompt_tokens + completion_tokens},
+        }
+
+    def _respond(self, request : httpx.Request) -> httpx.Response:
+        if request.url.host == 'serpapi.com':
+            if self._fails('serpapi'):
+                return httpx.Response(503, json = {'error' : 'injected failure'})
+            return httpx.Response(200, json = self._serpapi_payload(request.url.params.get('q', '')))
+        if self._fails('openai'):
+            return httpx.Response(500, json = {'error' : {'message' : 'injected failure', 'type' : 'server_error'}})
+        return httpx.Response(200, json = self._completion(json.loads(request.content)))
+
+    def _mean_latency(self, request : httpx.Request) -> float:
+        return self.serpapi_latency if request.url.host == 'serpapi.com' else self.openai_latency
+
+    def handle(self, request : httpx.Request) -> httpx.Response:
+        time.sleep(self._latency(self._mean_latency(request)))
+        return self._respond(request)
+
+    async def ahandle(self, request : httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self._latency(self._mean_latency(request)))
+        return self._respond(request)
+
+    def install(self):
+        #takes the place of the process-wide clients, so that the agent picks these up instead of creating its own
+        transport, async_transport = httpx.MockTransport(self.handle), httpx.MockTransport(self.ahandle)
+        with clients._clients_lock:
+            clients._clients['openai'] = OpenAI(api_key = 'benchmark', max_retries = 0, http_client = httpx.Client(transport = transport))
+            clients._clients['async_openai'] = AsyncOpenAI(api_key = 'benchmark', max_retries = 0, http_client = httpx.AsyncClient(transport = async_transport))
+            clients._clients['serpapi'] = httpx.Client(transport = transport)
+            clients._clients['async_serpapi'] = httpx.AsyncClient(transport = async_transport)
+
+def load_payloads(directory : str) -> list:
+    #recorded SerpAPI responses, one json file each, which are replayed in turn
+    if not directory:
+        return []
+    return [json.load(open(path)) for path in sorted(glob.glob(os.path.join(directory, '*.json')))]
+
+def _run_agent(services : FakeServices, size : int, unique : int, tag : str, args) -> float:
+    services.reset()
+    if get_completion_cache() is not None: #COMPLETION_CACHE=off is set above, this only matters when the cache is swapped back in
+        get_completion_cache().clear()
+    column = [f'Company {size}{tag}-{index % unique}' for index in range(size)] #named after the size and the pass, so that no run is served from the search cache of another
+    agent_class = AsyncSearchAgent if args.use_async else SearchAgent
+    agent = agent_class(column, max_concurrency = args.max_concurrency, batch_size = args.batch_size)
+    start = time.perf_counter()
+    agent.invoke(args.prompt)
+    return time.perf_counter() - start
+
+def peak_memory(services : FakeServices, size : int, unique : int, args) -> int:
+    #a pass of its own, tracemalloc slows down every allocation and would otherwise inflate the wall time
+    tracemalloc.start()
+    _run_agent(services, size, unique, 'm', args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def run_once(services : FakeServices, size : int, unique : int, args) -> dict:
+    scheduler = get_scheduler()
+    retries = dict(scheduler.retries)
+    wall_time = _run_agent(services, size, unique, '', args)
+    result = {
+        'size' : size,
+        'unique' : unique,
+        'wall_time' : round(wall_time, 3),
+        'calls' : dict(services.calls),
+        'injected_errors' : dict(services.errors),
+        'retries' : {provider : count - retries.get(provider, 0) for provider, count in scheduler.retries.items()},
+        'prompt_tokens' : services.prompt_tokens,
+        'completion_tokens' : services.completion_tokens,
+    }
+    result['peak_memory_bytes'] = peak_memory(services, size, unique, args) if args.memory else None
+    return result
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks SearchAgent against local stand-ins for SerpAPI and OpenAI.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [5, 50, 500], help = 'rows in the column of each run')
+    parser.add_argument('--unique-ratio', type = float, default = 1.0, help = 'share of the rows which are unique values')
+    parser.add_argument('--serpapi-latency', type = float, default = 0.3, help = 'mean seconds per search')
+    parser.add_argument('--openai-latency', type = float, default = 0.8, help = 'mean seconds per completion')
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = 'share of requests which fail with a server error')
+    parser.add_argument('--payloads', default = None, help = 'a directory of recorded SerpAPI responses to replay, as json files')
+    parser.add_argument('--prompt', nargs = '+', default = ['Find me the email and address of the headquarters for the company - {company}.'], help = 'one or more queries, run over a shared search pass')
+    parser.add_argument('--batch-size', type = int, default = 10)
+    parser.add_argument('--max-concurrency', type = int, default = 5)
+    parser.add_argument('--async', dest = 'use_async', action = 'store_true', help = 'runs AsyncSearchAgent instead of SearchAgent')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-memory', dest = 'memory', action = 'store_false', help = 'skips the extra pass which measures peak memory')
+    parser.add_argument('--output', default = None, help = 'where the json report goes, benchmarks/<timestamp>.json by default')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+    services = FakeServices(args.serpapi_latency, args.openai_latency, args.error_rate, load_payloads(args.payloads), seed = args.seed)
+    services.install()
+    results = []
+    for size in args.sizes:
+        unique = max(1, round(size * args.unique_ratio))
+        result = run_once(services, size, unique, args)
+        results.append(result)
+        print(f"{size:>6} rows  {result['wall_time']:>8.2f}s  serpapi {result['calls']['serpapi']:>5}  openai {result['calls']['openai']:>5}  prompt tokens {result['prompt_tokens']:>9}  peak memory {result['peak_memory_bytes'] / 2 ** 20 if result['peak_memory_bytes'] is not None else float('nan'):>7.1f} MiB")
+
+    report = {'created_at' : datetime.now().isoformat(timespec = 'seconds'), 'config' : {key : value for key, value in vars(args).items() if key != 'output'}, 'results' : results}
+    output = args.output or os.path.join('benchmarks', f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok = True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent = 2)
+    print(f'Saved the report to {output}')
+
+if __name__ == '__main__':
+    sys.exit(main())
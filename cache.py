@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional
+from pydantic import BaseModel
+from dotenv import load_dotenv
+from collections import OrderedDict
+load_dotenv(dotenv_path='.env')
+
+SEARCH_CACHE_PATH = os.environ.get('SEARCH_CACHE_PATH', '.cache/search_cache.sqlite')
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 7 * 24 * 60 * 60)) #in seconds
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 10000))
+SEARCH_CACHE_BYPASS = os.environ.get('SEARCH_CACHE_BYPASS', '').lower() in ['1', 'true', 'yes']
+COMPLETION_CACHE = os.environ.get('COMPLETION_CACHE', 'memory').lower() #one of memory, disk or off
+COMPLETION_CACHE_PATH = os.environ.get('COMPLETION_CACHE_PATH', '.cache/completion_cache.sqlite')
+COMPLETION_CACHE_TTL = int(os.environ['COMPLETION_CACHE_TTL']) if os.environ.get('COMPLETION_CACHE_TTL') else None
+COMPLETION_CACHE_MAX_ENTRIES = int(os.environ.get('COMPLETION_CACHE_MAX_ENTRIES', 2000))
+PAGE_CACHE_PATH = os.environ.get('PAGE_CACHE_PATH', '.cache/page_cache.sqlite')
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 24 * 60 * 60)) #in seconds, after which a page is revalidated
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 5000))
+
+def normalize_search_params(params : dict):
+    #only the parameters which change the search results make up the key, the api key in particular is left out
+    normalized = {key : ' '.join(str(params.get(key, '')).split()).lower() for key in ['q', 'hl', 'gl', 'google_domain']}
+    return hashlib.sha256(json.dumps(normalized, sort_keys = True).encode('utf-8')).hexdigest()
+
+class SQLiteCache:
+    def __init__(self, path : str, table : str, ttl : Optional[int], max_entries : int):
+        self.path = path
+        self.table = table
+        self.ttl = ttl #None keeps entries until they are evicted for space
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._connection = sqlite3.connect(path, check_same_thread = False, timeout = 30)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+            self._connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)')
+
+    def _expired(self, created_at : float, now : float):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key : str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(f'SELECT value, created_at FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None or self._expired(row[1], now):
+                if row is not None:
+                    self._connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            self._connection.execute(f'UPDATE {self.table} SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return row[0]
+
+    def set(self, key : str, value : str):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(f'INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)', (key, value, now, now))
+            self._evict(now)
+
+    def _evict(self, now : float):
+        if self.ttl is not None:
+            self._connection.execute(f'DELETE FROM {self.table} WHERE created_at < ?', (now - self.ttl,))
+        self._connection.execute(f'DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute(f'DELETE FROM {self.table}')
+
+    def stats(self):
+        with self._lock:
+            size = self._connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {'hits' : self.hits, 'misses' : self.misses, 'hit_rate' : self.hits / lookups if lookups else 0.0, 'size' : size}
+
+class SearchCache(SQLiteCache):
+    def __init__(self, path : str = SEARCH_CACHE_PATH, ttl : int = SEARCH_CACHE_TTL, max_entries : int = SEARCH_CACHE_MAX_ENTRIES, bypass : bool = SEARCH_CACHE_BYPASS):
+        super().__init__(path, 'search_cache', ttl, max_entries)
+        self.bypass = bypass
+
+    def get(self, params : dict, bypass : bool = False) -> Optional[dict]:
+        if self.bypass or bypass:
+            return None
+        response = super().get(normalize_search_params(params))
+        return None if response is None else json.loads(response)
+
+    def set(self, params : dict, response : dict):
+        if 'error' in response: #failed searches are not worth keeping around
+            return
+        super().set(normalize_search_params(params), json.dumps(response))
+
+class PageCache(SQLiteCache):
+    #the text extracted from a page along with its validators, stale entries are kept so that they can be revalidated with a conditional request
+    def __init__(self, path : str = PAGE_CACHE_PATH, ttl : int = PAGE_CACHE_TTL, max_entries : int = PAGE_CACHE_MAX_ENTRIES):
+        super().__init__(path, 'page_cache', None, max_entries)
+        self.page_ttl = ttl
+
+    def get(self, url : str) -> Optional[dict]:
+        entry = super().get(url)
+        return None if entry is None else json.loads(entry)
+
+    def fresh(self, entry : dict) -> bool:
+        return time.time() - entry['fetched_at'] <= self.page_ttl
+
+    def set(self, url : str, text : str, etag : Optional[str] = None, last_modified : Optional[str] = None):
+        super().set(url, json.dumps({'text' : text, 'etag' : etag, 'last_modified' : last_modified, 'fetched_at' : time.time()}))
+
+class MemoryCompletionCache:
+    def __init__(self, max_entries : int = COMPLETION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key : str) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key : str, value : str):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits' : self.hits, 'misses' : self.misses, 'hit_rate' : self.hits / lookups if lookups else 0.0, 'size' : len(self._entries)}
+
+class DiskCompletionCache(SQLiteCache):
+    def __init__(self, path : str = COMPLETION_CACHE_PATH, ttl : Optional[int] = COMPLETION_CACHE_TTL, max_entries : int = COMPLETION_CACHE_MAX_ENTRIES):
+        super().__init__(path, 'completion_cache', ttl, max_entries)
+
+def completion_key(model : str, messages : list, response_format = None):
+    if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+        response_format = {'pydantic' : response_format.__name__, 'schema' : response_format.model_json_schema()}
+    request = {'model' : model, 'messages' : messages, 'response_format' : response_format}
+    return hashlib.sha256(json.dumps(request, sort_keys = True, default = str).encode('utf-8')).hexdigest()
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+def get_search_cache() -> SearchCache:
+    #a single cache per process, so that every session of the app shares the same hit/miss counters and connection
+    global _search_cache
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache()
+        return _search_cache
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache() -> PageCache:
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache()
+        return _page_cache
+
+_completion_cache = None
+_completion_cache_configured = False
+_completion_cache_lock = threading.Lock()
+
+def get_completion_cache():
+    #None when completion caching is turned off
+    global _completion_cache, _completion_cache_configured
+    with _completion_cache_lock:
+        if not _completion_cache_configured:
+            if COMPLETION_CACHE == 'disk':
+                _completion_cache = DiskCompletionCache()
+            elif COMPLETION_CACHE == 'memory':
+                _completion_cache = MemoryCompletionCache()
+            _completion_cache_configured = True
+        return _completion_cache
+
+def set_completion_cache(cache):
+    #swaps in any object with get(key), set(key, value) and stats(), or None to turn the cache off
+    global _completion_cache, _completion_cache_configured
+    with _completion_cache_lock:
+        _completion_cache = cache
+        _completion_cache_configured = True
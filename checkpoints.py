@@ -0,0 +1,53 @@
+import os
+import asyncio
+import sqlite3
+import aiosqlite
+import threading
+from dotenv import load_dotenv
+from clients import get_event_loop
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+load_dotenv(dotenv_path='.env')
+
+CHECKPOINT_PATH = os.environ.get('CHECKPOINT_PATH', '.cache/checkpoints.sqlite')
+
+#the graph state is saved here after every node of a run with a job id, so that the run can pick up from its last completed node
+_checkpointers = dict()
+_checkpointers_lock = threading.Lock()
+
+def _prepare_path():
+    if os.path.dirname(CHECKPOINT_PATH):
+        os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok = True)
+
+def get_checkpointer() -> SqliteSaver:
+    with _checkpointers_lock:
+        if 'sync' not in _checkpointers:
+            _prepare_path()
+            _checkpointers['sync'] = SqliteSaver(sqlite3.connect(CHECKPOINT_PATH, check_same_thread = False))
+        return _checkpointers['sync']
+
+def delete_job_checkpoints(job_id : str):
+    #a job is saved as one thread per batch, `<job_id>:<batch>`, which are of no more use once the job is done
+    prefix = f'{job_id}:'
+    with get_checkpointer().cursor() as cursor:
+        for table in ['checkpoints', 'writes']:
+            cursor.execute(f'DELETE FROM {table} WHERE substr(thread_id, 1, ?) = ?', (len(prefix), prefix))
+
+async def _create_async_checkpointer() -> AsyncSqliteSaver:
+    return AsyncSqliteSaver(aiosqlite.connect(CHECKPOINT_PATH))
+
+def get_async_checkpointer() -> AsyncSqliteSaver:
+    #the saver belongs to the event loop it is created on, hence it is always created on the shared loop from clients.get_event_loop
+    with _checkpointers_lock:
+        if 'async' not in _checkpointers:
+            _prepare_path()
+            loop = get_event_loop()
+            try:
+                running_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                running_loop = None
+            if running_loop is loop:
+                _checkpointers['async'] = AsyncSqliteSaver(aiosqlite.connect(CHECKPOINT_PATH))
+            else:
+                _checkpointers['async'] = asyncio.run_coroutine_threadsafe(_create_async_checkpointer(), loop).result()
+        return _checkpointers['async']
@@ -0,0 +1,91 @@
+import os
+import httpx
+import asyncio
+import threading
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+from scheduler import get_scheduler
+load_dotenv(dotenv_path='.env')
+
+SERPAPI_URL = 'https://serpapi.com/search'
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', 20))
+SERPAPI_MAX_CONNECTIONS = int(os.environ.get('SERPAPI_MAX_CONNECTIONS', 10))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('MAX_KEEPALIVE_CONNECTIONS', 10))
+KEEPALIVE_EXPIRY = float(os.environ.get('KEEPALIVE_EXPIRY', 60)) #in seconds
+SERPAPI_TIMEOUT = float(os.environ.get('SERPAPI_TIMEOUT', 60)) #in seconds
+PAGE_MAX_CONNECTIONS = int(os.environ.get('PAGE_MAX_CONNECTIONS', 20))
+PAGE_TIMEOUT = float(os.environ.get('PAGE_TIMEOUT', 10)) #in seconds
+PAGE_HEADERS = {'User-Agent' : 'Mozilla/5.0 (compatible; Seeker-Agent)', 'Accept' : 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.1'}
+
+#every client below is created once per process and shared by all sessions of the app, so that connections are kept alive and reused
+_clients = dict()
+_clients_lock = threading.Lock()
+_event_loop = None
+
+def _limits(max_connections : int) -> httpx.Limits:
+    return httpx.Limits(max_connections = max_connections, max_keepalive_connections = min(MAX_KEEPALIVE_CONNECTIONS, max_connections), keepalive_expiry = KEEPALIVE_EXPIRY)
+
+def _get_client(name : str, factory):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    #async clients are bound to the event loop they were first used on, hence all async work of the process runs on this one loop in a background thread
+    global _event_loop
+    with _clients_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target = _event_loop.run_forever, name = 'seeker-event-loop', daemon = True).start()
+        return _event_loop
+
+def run_async(coroutine):
+    #runs a coroutine on the shared event loop and blocks until it is done, for callers outside of it such as the Streamlit script
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+def get_openai() -> OpenAI:
+    #retries are left to the scheduler, which also takes care of the rate limits
+    return _get_client('openai', lambda : OpenAI(max_retries = 0, http_client = httpx.Client(limits = _limits(OPENAI_MAX_CONNECTIONS))))
+
+def get_async_openai() -> AsyncOpenAI:
+    return _get_client('async_openai', lambda : AsyncOpenAI(max_retries = 0, http_client = httpx.AsyncClient(limits = _limits(OPENAI_MAX_CONNECTIONS))))
+
+def get_serpapi_client() -> httpx.Client:
+    return _get_client('serpapi', lambda : httpx.Client(limits = _limits(SERPAPI_MAX_CONNECTIONS), timeout = SERPAPI_TIMEOUT))
+
+def get_async_serpapi_client() -> httpx.AsyncClient:
+    return _get_client('async_serpapi', lambda : httpx.AsyncClient(limits = _limits(SERPAPI_MAX_CONNECTIONS), timeout = SERPAPI_TIMEOUT))
+
+def get_page_client() -> httpx.Client:
+    #for the pages of the search results, any site on the web, hence a short timeout and redirects followed
+    return _get_client('page', lambda : httpx.Client(limits = _limits(PAGE_MAX_CONNECTIONS), timeout = PAGE_TIMEOUT, follow_redirects = True, headers = PAGE_HEADERS))
+
+def get_async_page_client() -> httpx.AsyncClient:
+    return _get_client('async_page', lambda : httpx.AsyncClient(limits = _limits(PAGE_MAX_CONNECTIONS), timeout = PAGE_TIMEOUT, follow_redirects = True, headers = PAGE_HEADERS))
+
+def _serpapi_params(params : dict):
+    return {'engine' : 'google', 'output' : 'json', 'source' : 'python', **params}
+
+def _serpapi_json(response : httpx.Response) -> dict:
+    #SerpAPI reports failed searches as a json body with an `error` key, same as GoogleSearch.get_dict did
+    #rate limited and server side failures are raised instead, so that the scheduler retries them
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    try:
+        return response.json()
+    except ValueError:
+        response.raise_for_status()
+        raise
+
+def _serpapi_get(params : dict) -> dict:
+    return _serpapi_json(get_serpapi_client().get(SERPAPI_URL, params = _serpapi_params(params)))
+
+async def _aserpapi_get(params : dict) -> dict:
+    return _serpapi_json(await get_async_serpapi_client().get(SERPAPI_URL, params = _serpapi_params(params)))
+
+def serpapi_search(params : dict) -> dict:
+    return get_scheduler().call('serpapi', _serpapi_get, params)
+
+async def aserpapi_search(params : dict) -> dict:
+    return await get_scheduler().acall('serpapi', _aserpapi_get, params)
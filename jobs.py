@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import multiprocessing
+import threading
+from typing import List, Optional, Union
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+load_dotenv(dotenv_path='.env')
+
+JOBS_PATH = os.environ.get('JOBS_PATH', '.cache/jobs.sqlite')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4)) #jobs running at the same time
+JOB_BACKEND = os.environ.get('JOB_BACKEND', 'thread').lower() #thread or process
+
+#searches run as jobs in the background, apart from the Streamlit script, so that reruns and refreshes of the page neither block nor kill them
+#submitting returns a job id right away, the worker keeps the job's row in the table up to date and the page polls it
+#every job is checkpointed under its id, hence a job which was interrupted by a restart is picked up again from its last completed step
+FINISHED = ['done', 'failed']
+_COLUMNS = ['id', 'status', 'query', 'column_elements', 'attributes', 'total', 'searched', 'records', 'results', 'summary', 'error', 'submitted_at', 'started_at', 'finished_at']
+_JSON_COLUMNS = ['query', 'column_elements', 'attributes', 'records', 'results', 'summary']
+
+class JobStore:
+    def __init__(self, path : str = JOBS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._connection = sqlite3.connect(path, check_same_thread = False, timeout = 30)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, query TEXT NOT NULL, column_elements TEXT NOT NULL, attributes TEXT,
+                total INTEGER NOT NULL, searched INTEGER NOT NULL DEFAULT 0, records TEXT, results TEXT, summary TEXT, error TEXT,
+                submitted_at REAL NOT NULL, started_at REAL, finished_at REAL)''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+    def create(self, job_id : str, query : Union[str, List[str]], column_elements : List[str], attributes : Optional[List[str]] = None):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO jobs (id, status, query, column_elements, attributes, total, records, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(query), json.dumps(column_elements), json.dumps(attributes), len([element for element in dict.fromkeys(column_elements) if element.strip()]), json.dumps(dict()), time.time())
+            )
+
+    def update(self, job_id : str, **values):
+        values = {key : json.dumps(value) if key in _JSON_COLUMNS else value for key, value in values.items()}
+        with self._lock, self._connection:
+            self._connection.execute(f'UPDATE jobs SET {", ".join(f"{key} = ?" for key in values)} WHERE id = ?', (*values.values(), job_id))
+
+    def _job(self, row) -> dict:
+        job = dict(zip(_COLUMNS, row))
+        for key in _JSON_COLUMNS:
+            job[key] = self._loads(key, job[key])
+        return job
+
+    def _loads(self, key : str, value : Optional[str]):
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            if key == 'query': #jobs submitted before several prompts were allowed kept the query as plain text
+                return value
+            raise
+
+    def get(self, job_id : str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(f'SELECT {", ".join(_COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def requeue(self, job_id : str) -> bool:
+        #only a failed job goes back in the queue, checked in the same statement so that two retries at once can't both run it
+        with self._lock, self._connection:
+            cursor = self._connection.execute("UPDATE jobs SET status = 'queued', error = NULL, finished_at = NULL WHERE id = ? AND status = 'failed'", (job_id,))
+        return cursor.rowcount == 1
+
+    def unfinished(self) -> List[str]:
+        with self._lock:
+            rows = self._connection.execute('SELECT id FROM jobs WHERE status NOT IN (?, ?) ORDER BY submitted_at', tuple(FINISHED)).fetchall()
+        return [row[0] for row in rows]
+
+def run_job(job_id : str, path : str = JOBS_PATH):
+    #runs in a worker thread or process, only the job id crosses over and everything else is read from the table
+    from agents import AsyncSearchAgent
+    from checkpoints import delete_job_checkpoints
+    store = get_job_store(path)
+    job = store.get(job_id)
+    store.update(job_id, status = 'running', started_at = job['started_at'] or time.time(), error = None)
+    try:
+        agent = AsyncSearchAgent(job['column_elements'], attributes = job['attributes'], job_id = job_id) #checkpointed under the job id
+        records = job['records'] or dict()
+        searched = set() #resumed searches come back again, each element is counted once
+        for event in agent.stream(job['query']):
+            if event['stage'] == 'search':
+                searched.add(event['element'])
+                store.update(job_id, searched = min(max(len(searched), job['searched']), job['total']))
+            elif event['stage'] == 'extract_llm':
+                records.update(event['records'])
+                store.update(job_id, records = records)
+            elif event['stage'] == 'done':
+                store.update(job_id, status = 'done', searched = job['total'], results = event['results'], summary = event['summary'], finished_at = time.time())
+                delete_job_checkpoints(job_id) #a done job is never resumed, and its checkpoints would otherwise pile up
+    except Exception as exc:
+        store.update(job_id, status = 'failed', error = f'{type(exc).__name__}: {exc}', finished_at = time.time())
+
+class JobQueue:
+    def __init__(self, store : JobStore, workers : int = JOB_WORKERS, backend : str = JOB_BACKEND):
+        self.store = store
+        if backend == 'process':
+            #spawned rather than forked, the app process has threads of its own (the shared event loop) which a fork would copy in whatever state they are in
+            self.executor = ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context('spawn'))
+        elif backend == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'seeker-job')
+        else:
+            raise ValueError(f'Unknown job backend {backend}, JOB_BACKEND takes thread or process')
+        for job_id in self.store.unfinished(): #left over from a previous run of the app
+            self._enqueue(job_id)
+
+    def _enqueue(self, job_id : str):
+        self.executor.submit(run_job, job_id, self.store.path)
+
+    def submit(self, column_elements : List[str], query : Union[str, List[str]], attributes : Optional[List[str]] = None) -> str:
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, query, column_elements, attributes)
+        self._enqueue(job_id)
+        return job_id
+
+    def retry(self, job_id : str) -> bool:
+        #a failed job starts over from its last checkpoint, a job which has already been retried is left as it is
+        if not self.store.requeue(job_id):
+            return False
+        self._enqueue(job_id)
+        return True
+
+    def get(self, job_id : str) -> Optional[dict]:
+        return self.store.get(job_id)
+
+_stores = dict()
+_stores_lock = threading.Lock()
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_job_store(path : str = JOBS_PATH) -> JobStore:
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = JobStore(path)
+        return _stores[path]
+
+def get_job_queue() -> JobQueue:
+    #one queue per process, shared by every session of the app
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(get_job_store())
+        return _queue
@@ -1,9 +1,11 @@
 import os
 import json
+import time
 import gspread
 import pandas as pd 
 import streamlit as st
-from agents import SearchAgent
+from jobs import get_job_queue
+from sheets import SheetWriter, read_preview, read_column
 from dotenv import load_dotenv
 from oauth2client.service_account import ServiceAccountCredentials
 load_dotenv(dotenv_path='.env')
@@ -46,6 +48,40 @@ if 'worksheet' not in st.session_state:
     st.session_state.worksheet = None  
 if 'results' not in st.session_state:
     st.session_state.results = None  
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = None
+if 'selected_column' not in st.session_state:
+    st.session_state.selected_column = None
+if 'run_summary' not in st.session_state:
+    st.session_state.run_summary = None
+if 'records' not in st.session_state:
+    st.session_state.records = None
+if 'stream_to_sheet' not in st.session_state:
+    st.session_state.stream_to_sheet = False
+if 'sheet_writer' not in st.session_state:
+    st.session_state.sheet_writer = None
+if 'sheet_written' not in st.session_state:
+    st.session_state.sheet_written = set()
+
+def write_to_sheet(records : dict):
+    #writes the records which haven't been written yet into the columns right after the last one of the sheet, in a handful of batched updates
+    if st.session_state.sheet_writer is None:
+        st.session_state.sheet_writer = SheetWriter(st.session_state.worksheet, len(st.session_state.df.columns) + 1)
+    writer = st.session_state.sheet_writer
+    new_records = {element : record for element, record in records.items() if element not in st.session_state.sheet_written}
+    if not new_records:
+        return
+    if not writer.attributes:
+        writer.write_header(list(next(iter(new_records.values())).keys()))
+    writer.write_records(st.session_state.item_list, new_records)
+    st.session_state.sheet_written.update(new_records)
+if st.session_state.job_id is None and 'job' in st.query_params:
+    #the page was refreshed or reopened, and picks the job back up from the link
+    job = get_job_queue().get(st.query_params['job'])
+    if job is not None:
+        st.session_state.job_id = job['id']
+        st.session_state.user_prompt = job['query']
+        st.session_state.item_list = job['column_elements']
        
 
 selection_content = st.empty()       
@@ -101,8 +137,7 @@ with selection_content.container():
             try:
                 sheet = st.session_state.google_sheet_client.open_by_url(st.session_state.google_sheet_link)
                 st.session_state.worksheet = sheet.sheet1
-                data = st.session_state.worksheet.get_all_records()
-                st.session_state.df = pd.DataFrame(data)
+                st.session_state.df = read_preview(st.session_state.worksheet) #only the header and the first few rows, the selected column is read in full later
                 st.success("Sheet loaded successfully", icon='✅')
                 st.table(st.session_state.df.head())
             
@@ -119,24 +154,51 @@ with selection_content.container():
         selected_column = st.radio("Choose one of the columns :", column_list)
         st.button("Confirm Choice", on_click = lambda : setattr(st.session_state, 'user_selection', True))
         if st.session_state.user_selection:
-            if df[selected_column].nunique() > 5:
-                st.error("Please select a column with at most 5 unique values", icon='🚨')
-                st.rerun()
-            else:
-                st.session_state.item_list = df[selected_column].to_list()
-                st.table(df[selected_column])   
-                st.session_state.user_prompt = st.text_input("Enter the prompt corresponding to the selected column : ", help = 'To generalise the prompt to all items in the column, you can include `{placeholder}` in your prompt.')
+            if st.session_state.item_list is None or st.session_state.selected_column != selected_column:
+                st.session_state.selected_column = selected_column
+                if data_source == 'google_sheet':
+                    st.session_state.item_list = read_column(st.session_state.worksheet, column_list.index(selected_column) + 1)
+                else:
+                    st.session_state.item_list = df[selected_column].fillna('').astype(str).to_list() #duplicates and empty cells are kept, the agent searches every unique value once, skips the empty ones and fills in every row
+            items = pd.Series(st.session_state.item_list, name = selected_column)
+            st.write(f'{items[items.str.strip() != ""].nunique()} unique values will be searched for {len(items)} rows.')
+            st.table(items.drop_duplicates().head())
+            prompts = st.text_area("Enter the prompts corresponding to the selected column, one per line : ", help = 'To generalise a prompt to all items in the column, you can include `{placeholder}` in it. Every item is searched once for all of the prompts.')
+            if data_source == 'google_sheet':
+                st.session_state.stream_to_sheet = st.checkbox('Write the results into my Google Sheet as they come in')
+            st.session_state.user_prompt = [prompt.strip() for prompt in prompts.splitlines() if prompt.strip()]
             
 if st.session_state.user_prompt:
     selection_content.empty()
     if not st.session_state.update_record:
-        with st.spinner('Looking for answers...'):
-            try:
-                search_agent = SearchAgent(st.session_state.item_list)
-                st.session_state.results = search_agent.invoke(st.session_state.user_prompt)
-            except Exception as e:
-                st.error("There seems to have been some error, but running it again often solves it!", icon = '🚨')
-    
+        queue = get_job_queue() #jobs run in the background, shared by every session, so that reruns and refreshes of this page don't hold them up
+        if st.session_state.job_id is None:
+            st.session_state.job_id = queue.submit(st.session_state.item_list, st.session_state.user_prompt)
+            st.query_params['job'] = st.session_state.job_id
+        job = queue.get(st.session_state.job_id)
+        if st.session_state.stream_to_sheet and st.session_state.worksheet is not None:
+            write_to_sheet(job['records']) #the batches which finished since the last poll
+        if job['status'] in ['queued', 'running']:
+            searched = job['searched']
+            st.progress(min(searched / job['total'], 1.0) if job['total'] else 0.0, text = 'Waiting for a free worker...' if job['status'] == 'queued' else f'Searched {searched} of {job["total"]} unique values...')
+            rows = {element : {'Status' : 'Done', **job['records'][element]} if element in job['records'] else {'Status' : 'Searching...'} for element in dict.fromkeys(job['column_elements']) if element.strip()}
+            st.table(pd.DataFrame.from_dict(rows, orient = 'index'))
+            time.sleep(1)
+            st.rerun()
+        if job['status'] == 'failed':
+            st.error("There seems to have been some error, but running it again often solves it!", icon = '🚨')
+            st.button('Run it again', on_click = lambda : queue.retry(st.session_state.job_id)) #picks up from the last completed step
+            st.stop()
+        st.session_state.results = job['results']
+        st.session_state.records = job['records']
+        st.session_state.run_summary = job['summary']
+        st.caption(f'Finished in {round(job["finished_at"] - job["started_at"], 2)} seconds.')
+        summary = st.session_state.run_summary
+        with st.expander('Run summary'):
+            #time spent per stage, and calls, cache hits, retries and tokens per provider
+            st.dataframe(pd.DataFrame.from_dict(summary['stages'], orient = 'index').round(2).rename_axis('Stage'))
+            st.dataframe(pd.DataFrame.from_dict(summary['calls'], orient = 'index').round(2).rename_axis('Provider'))
+
     new_page = st.empty()
     result_df = pd.DataFrame(st.session_state.results)
     with new_page.container():
@@ -146,24 +208,18 @@ if st.session_state.user_prompt:
     if st.session_state.update_record:
         new_page.empty()   
         if data_source == 'google_sheet':
-            print(f'Worksheet type is okay : {isinstance(st.session_state.worksheet, gspread.worksheet.Worksheet)}')
-            page = chr(ord('A') + len(st.session_state.df.columns.to_list())) + '1'
-            write = [result_df.columns.to_list()] + result_df.values.tolist()
-            for item in write:
-                for element in item:
-                    if isinstance(element, list) : 
-                        replace = str(element)
-                        replace = replace[1:-1] #removing the brackets from the string 
-                        item.remove(element)
-                        item.append(replace)
-
-            st.session_state.worksheet.update(write, page)
-            merged_df = pd.merge(st.session_state.df, result_df, left_index=True, right_index=True)
+            write_to_sheet(st.session_state.records) #whatever wasn't written while the job ran
+            merged_df = pd.concat([pd.Series(st.session_state.item_list, name = st.session_state.selected_column), result_df], axis = 1)
             st.table(merged_df)
             st.write('Your Google Sheet has been updated!')
             
-        else:
+        elif st.session_state.df is not None:
             merged_df = pd.merge(st.session_state.df, result_df, left_index=True, right_index=True)
             updated_csv = merged_df.to_csv()
             st.table(merged_df)
-            st.download_button('Download Updated CSV file', updated_csv, f'updated_{st.session_state.csv_file.name}', mime = 'text/csv')
\ No newline at end of file
+            st.download_button('Download Updated CSV file', updated_csv, f'updated_{st.session_state.csv_file.name}', mime = 'text/csv')
+
+        else: #a job picked back up from its link, the original file is no longer around
+            merged_df = pd.concat([pd.Series(st.session_state.item_list, name = 'Value'), result_df], axis = 1)
+            st.table(merged_df)
+            st.download_button('Download Results as CSV file', merged_df.to_csv(), 'results.csv', mime = 'text/csv')
\ No newline at end of file
@@ -0,0 +1,248 @@
+import os
+import re
+import time
+import httpx
+import asyncio
+import threading
+import contextvars
+from typing import List, Optional
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dotenv import load_dotenv
+from cache import get_page_cache
+from clients import PAGE_MAX_CONNECTIONS, get_page_client, get_async_page_client
+from tracing import span, call_span
+from utils import count_tokens, truncate_tokens
+load_dotenv(dotenv_path='.env')
+
+PAGE_FETCH_TOP_K = int(os.environ.get('PAGE_FETCH_TOP_K', 0)) #organic results whose pages are read, 0 leaves the pages out
+PAGE_FETCH_PER_DOMAIN = int(os.environ.get('PAGE_FETCH_PER_DOMAIN', 2)) #connections to any one site at a time
+PAGE_MAX_BYTES = int(os.environ.get('PAGE_MAX_BYTES', 2 * 1024 * 1024))
+PAGE_PASSAGE_TOKEN_BUDGET = int(os.environ.get('PAGE_PASSAGE_TOKEN_BUDGET', 300)) #per page, for the passages passed on to find_llm
+PAGE_FETCH_DEADLINE = float(os.environ.get('PAGE_FETCH_DEADLINE', 20)) #in seconds, for reading the pages of one search in full, PAGE_TIMEOUT only bounds each read
+
+#snippets often leave out what was asked for, such as an email or an address, which is on the page they were taken from
+#the top pages of the search results are read at the same time, their main text is kept in the page cache, and only the passages which match the query are passed on
+_SKIPPED_TAGS = ['script', 'style', 'noscript', 'template', 'svg', 'nav', 'header', 'footer', 'aside', 'form', 'iframe']
+_BLOCK_TAGS = ['p', 'div', 'section', 'article', 'main', 'li', 'ul', 'ol', 'tr', 'td', 'th', 'table', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'address', 'blockquote', 'pre', 'dd', 'dt']
+_MAIN_TAGS = ['main', 'article']
+_CONTACT = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+|\+?\d[\d ()-]{7,}\d') #emails and phone numbers
+_STOPWORDS = set('the and for with from that this what where which who how are was were find me my of in on at to a an is be or by as it its about into their'.split())
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs = True)
+        self.skipped = 0
+        self.main = 0
+        self.blocks = [[]]
+        self.main_blocks = [[]]
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self.skipped += 1
+        elif tag in _MAIN_TAGS:
+            self.main += 1
+        if tag in _BLOCK_TAGS:
+            self._break()
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self.skipped = max(self.skipped - 1, 0)
+        elif tag in _MAIN_TAGS:
+            self.main = max(self.main - 1, 0)
+        if tag in _BLOCK_TAGS:
+            self._break()
+
+    def _break(self):
+        for blocks in [self.blocks, self.main_blocks]:
+            if blocks[-1]:
+                blocks.append([])
+
+    def handle_data(self, data):
+        if self.skipped:
+            return
+        self.blocks[-1].append(data)
+        if self.main:
+            self.main_blocks[-1].append(data)
+
+    def text(self) -> str:
+        #the text inside main or article when the page marks it, otherwise the whole page, one block per line
+        blocks = self.main_blocks if any(self.main_blocks) else self.blocks
+        lines = [' '.join(''.join(block).split()) for block in blocks]
+        return '\n'.join(line for line in lines if line)
+
+def extract_text(html : str) -> str:
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+def relevant_passages(text : str, query : str, budget : int = PAGE_PASSAGE_TOKEN_BUDGET) -> List[str]:
+    #the lines which share the most words with the query, or carry contact details, kept in page order and under the token budget
+    terms = set(word for word in re.findall(r'\w+', query.lower()) if len(word) > 2 and word not in _STOPWORDS)
+    lines = [line for line in text.split('\n') if len(line) > 20]
+    scores = [len(terms & set(re.findall(r'\w+', line.lower()))) + 2 * bool(_CONTACT.search(line)) for line in lines]
+    chosen, used = [], 0
+    for index in sorted(range(len(lines)), key = lambda index : -scores[index]):
+        if scores[index] == 0:
+            break
+        passage = truncate_tokens(lines[index], budget)
+        cost = count_tokens(passage)
+        if used + cost > budget:
+            continue
+        chosen.append(index)
+        used += cost
+    return [truncate_tokens(lines[index], budget) for index in sorted(chosen)]
+
+def top_links(search_results : dict, top_k : int = PAGE_FETCH_TOP_K) -> List[str]:
+    links = [result.get('link') for result in search_results.get('organic_results', []) if isinstance(result, dict)]
+    return [link for link in links if isinstance(link, str) and link.startswith(('http://', 'https://'))][ : top_k]
+
+def _conditional_headers(entry : Optional[dict]) -> dict:
+    headers = dict()
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def _cached_text(url : str, call) -> tuple:
+    #the cached text when it is still fresh, along with the entry to revalidate otherwise
+    entry = get_page_cache().get(url)
+    if entry is not None and get_page_cache().fresh(entry):
+        call.set(cache_hit = True)
+        return entry['text'], entry
+    return None, entry
+
+def _readable(response : httpx.Response) -> bool:
+    #only html pages are read, the body of anything else is never downloaded
+    return response.status_code == 200 and 'html' in response.headers.get('content-type', 'text/html')
+
+def _decode(response : httpx.Response, body : bytes) -> str:
+    return body[ : PAGE_MAX_BYTES].decode(response.encoding or 'utf-8', errors = 'replace')
+
+def _read_html(response : httpx.Response, deadline : float) -> str:
+    #reading stops at PAGE_MAX_BYTES, so a page larger than that is cut short instead of downloaded in full
+    #a server which sends a little at a time is given up on at the deadline, rather than after one PAGE_TIMEOUT per read
+    body = bytearray()
+    for chunk in response.iter_bytes():
+        body.extend(chunk)
+        if len(body) >= PAGE_MAX_BYTES:
+            break
+        if time.monotonic() > deadline:
+            raise httpx.ReadTimeout('The page was not read within PAGE_FETCH_DEADLINE')
+    return _decode(response, bytes(body))
+
+async def _aread_html(response : httpx.Response) -> str:
+    body = bytearray()
+    async for chunk in response.aiter_bytes():
+        body.extend(chunk)
+        if len(body) >= PAGE_MAX_BYTES:
+            break
+    return _decode(response, bytes(body))
+
+def _page_text(url : str, entry : Optional[dict], response : httpx.Response, html : Optional[str], call) -> str:
+    call.set(status_code = response.status_code)
+    cache = get_page_cache()
+    if response.status_code == 304 and entry is not None: #unchanged since it was cached
+        call.set(cache_hit = True, revalidated = True)
+        cache.set(url, entry['text'], entry.get('etag'), entry.get('last_modified'))
+        return entry['text']
+    if html is None:
+        return ''
+    text = extract_text(html)
+    cache.set(url, text, response.headers.get('etag'), response.headers.get('last-modified'))
+    return text
+
+_domain_locks = dict()
+_domain_locks_lock = threading.Lock()
+_executor = None
+
+def _domain_semaphore(url : str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc.lower()
+    with _domain_locks_lock:
+        if host not in _domain_locks:
+            _domain_locks[host] = threading.BoundedSemaphore(PAGE_FETCH_PER_DOMAIN)
+        return _domain_locks[host]
+
+def _fetch(url : str, deadline : float) -> str:
+    with call_span('page', url = url) as call:
+        text, entry = _cached_text(url, call)
+        if text is not None:
+            return text
+        try:
+            with _domain_semaphore(url):
+                with get_page_client().stream('GET', url, headers = _conditional_headers(entry)) as response:
+                    html = _read_html(response, deadline) if _readable(response) else None
+            return _page_text(url, entry, response, html, call)
+        except (httpx.HTTPError, ValueError) as exc: #a page which can't be read is left out, the search results still stand
+            call.set(failed = f'{type(exc).__name__}: {exc}')
+            return ''
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _domain_locks_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers = PAGE_MAX_CONNECTIONS, thread_name_prefix = 'seeker-page')
+        return _executor
+
+def _result(future, deadline : float) -> str:
+    #a page still being read at the deadline is left out, its thread stops at its next read
+    try:
+        return future.result(timeout = max(deadline - time.monotonic(), 0))
+    except FutureTimeoutError:
+        return ''
+
+def _passages(links : List[str], texts : List[str], query : str) -> List[dict]:
+    pages = [{'link' : link, 'passages' : relevant_passages(text, query)} for link, text in zip(links, texts)]
+    return [page for page in pages if page['passages']]
+
+def fetch_pages(search_results : dict, query : str, top_k : int = PAGE_FETCH_TOP_K) -> List[dict]:
+    #the relevant passages of each of the top pages, read at the same time
+    links = top_links(search_results, top_k)
+    if not links:
+        return []
+    with span('fetch_pages', kind = 'node', pages = len(links)):
+        executor = _get_executor()
+        deadline = time.monotonic() + PAGE_FETCH_DEADLINE
+        futures = [executor.submit(contextvars.copy_context().run, _fetch, link, deadline) for link in links] #copied so that the page spans sit under this one
+        return _passages(links, [_result(future, deadline) for future in futures], query)
+
+_async_domain_locks = dict()
+
+def _async_domain_semaphore(url : str) -> asyncio.Semaphore:
+    #only ever used on the shared event loop, which the semaphores belong to
+    host = urlsplit(url).netloc.lower()
+    if host not in _async_domain_locks:
+        _async_domain_locks[host] = asyncio.Semaphore(PAGE_FETCH_PER_DOMAIN)
+    return _async_domain_locks[host]
+
+async def _afetch(url : str) -> str:
+    #the cache and the parsing of the page run in a worker thread, the shared event loop carries every other job at the same time
+    with call_span('page', url = url) as call:
+        text, entry = await asyncio.to_thread(_cached_text, url, call)
+        if text is not None:
+            return text
+        try:
+            async with _async_domain_semaphore(url):
+                async with get_async_page_client().stream('GET', url, headers = _conditional_headers(entry)) as response:
+                    html = await _aread_html(response) if _readable(response) else None
+            return await asyncio.to_thread(_page_text, url, entry, response, html, call)
+        except (httpx.HTTPError, ValueError) as exc:
+            call.set(failed = f'{type(exc).__name__}: {exc}')
+            return ''
+
+async def _afetch_within(url : str) -> str:
+    try:
+        return await asyncio.wait_for(_afetch(url), timeout = PAGE_FETCH_DEADLINE)
+    except asyncio.TimeoutError: #cancels the read, the page is left out
+        return ''
+
+async def afetch_pages(search_results : dict, query : str, top_k : int = PAGE_FETCH_TOP_K) -> List[dict]:
+    links = top_links(search_results, top_k)
+    if not links:
+        return []
+    with span('fetch_pages', kind = 'node', pages = len(links)):
+        texts = await asyncio.gather(*[_afetch_within(link) for link in links])
+        return _passages(links, texts, query)
@@ -0,0 +1,147 @@
+import os
+import time
+import httpx
+import random
+import openai
+import gspread
+import asyncio
+import threading
+from typing import Optional
+from tracing import record_retry
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+load_dotenv(dotenv_path='.env')
+
+OPENAI_REQUESTS_PER_MINUTE = float(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', 500))
+OPENAI_BURST = int(os.environ.get('OPENAI_BURST', 10))
+SERPAPI_REQUESTS_PER_MINUTE = float(os.environ.get('SERPAPI_REQUESTS_PER_MINUTE', 100))
+SERPAPI_BURST = int(os.environ.get('SERPAPI_BURST', 5))
+SHEETS_REQUESTS_PER_MINUTE = float(os.environ.get('SHEETS_REQUESTS_PER_MINUTE', 60)) #the default write quota of the Sheets API, per user
+SHEETS_BURST = int(os.environ.get('SHEETS_BURST', 5))
+MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 5))
+BACKOFF_BASE = float(os.environ.get('BACKOFF_BASE', 1)) #in seconds
+BACKOFF_MAX = float(os.environ.get('BACKOFF_MAX', 60)) #in seconds
+
+class TokenBucket:
+    def __init__(self, requests_per_minute : float, burst : int):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        #takes a token right away and returns how long the caller has to wait before using it, which lets sync and async callers share the bucket
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, self.blocked_until - now, 0.0)
+
+    def block(self, seconds : float):
+        #a provider asking us to slow down holds back every caller, not only the one who got the 429
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def _status_code(exc : Exception) -> Optional[int]:
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code
+    if isinstance(exc, gspread.exceptions.APIError):
+        return exc.response.status_code
+    return None
+
+def is_retryable(exc : Exception) -> bool:
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError)): #includes timeouts
+        return True
+    status_code = _status_code(exc)
+    return status_code is not None and (status_code in [408, 409, 429] or status_code >= 500)
+
+def retry_after(exc : Exception) -> Optional[float]:
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+class Scheduler:
+    #every OpenAI, SerpAPI and Sheets request goes through `call` or `acall`, which rate limit per provider and retry transient failures
+    def __init__(self, buckets : dict, max_retries : int = MAX_RETRIES, backoff_base : float = BACKOFF_BASE, backoff_max : float = BACKOFF_MAX):
+        self.buckets = buckets
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = {provider : 0 for provider in buckets}
+        self._lock = threading.Lock()
+
+    def _delay(self, provider : str, exc : Exception, attempt : int) -> Optional[float]:
+        #None when the exception should be raised instead of retried
+        if attempt >= self.max_retries or not is_retryable(exc):
+            return None
+        with self._lock:
+            self.retries[provider] += 1
+        record_retry() #counted on the span of the call being retried
+        delay = retry_after(exc)
+        if delay is not None:
+            delay = min(delay, self.backoff_max) #a provider asking for a longer wait than that is not waited on any longer
+            self.buckets[provider].block(delay)
+            return delay
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)) #exponential backoff with full jitter
+
+    def call(self, provider : str, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            time.sleep(self.buckets[provider].reserve())
+            try:
+                return fn(*args, **kwargs)
+            except Exception as exc:
+                delay = self._delay(provider, exc, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, provider : str, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.buckets[provider].reserve())
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as exc:
+                delay = self._delay(provider, exc, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> Scheduler:
+    #one scheduler per process, the rate limits are per API key and so are shared by every session of the app
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler({
+                'openai' : TokenBucket(OPENAI_REQUESTS_PER_MINUTE, OPENAI_BURST),
+                'serpapi' : TokenBucket(SERPAPI_REQUESTS_PER_MINUTE, SERPAPI_BURST),
+                'sheets' : TokenBucket(SHEETS_REQUESTS_PER_MINUTE, SHEETS_BURST),
+            })
+        return _scheduler
@@ -0,0 +1,107 @@
+import os
+import pandas as pd
+from typing import Dict, List
+from gspread.worksheet import Worksheet
+from scheduler import get_scheduler
+from dotenv import load_dotenv
+load_dotenv(dotenv_path='.env')
+
+SHEETS_WRITE_ROWS = int(os.environ.get('SHEETS_WRITE_ROWS', 500)) #rows written per request
+SHEETS_PREVIEW_ROWS = int(os.environ.get('SHEETS_PREVIEW_ROWS', 5))
+
+#every request to the Sheets API goes through the scheduler, which keeps them under SHEETS_REQUESTS_PER_MINUTE and retries rate limited ones
+#reads only ask for the header, a few rows to preview and the selected column, and writes go out as a few batch updates instead of a cell or a row at a time
+
+def column_letter(column : int) -> str:
+    #1 is A, 26 is Z, 27 is AA and so on
+    letters = ''
+    while column > 0:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+def cell_range(first_column : int, first_row : int, last_column : int, last_row : int) -> str:
+    return f'{column_letter(first_column)}{first_row}:{column_letter(last_column)}{last_row}'
+
+def _call(fn, *args, **kwargs):
+    return get_scheduler().call('sheets', fn, *args, **kwargs)
+
+def read_preview(worksheet : Worksheet, rows : int = SHEETS_PREVIEW_ROWS) -> pd.DataFrame:
+    #the header and the first few rows, enough to choose a column from
+    values = _call(worksheet.get, f'1:{rows + 1}')
+    if not values:
+        return pd.DataFrame()
+    header = values[0]
+    return pd.DataFrame([(row + [''] * len(header))[ : len(header)] for row in values[1 : ]], columns = header)
+
+def read_column(worksheet : Worksheet, column : int) -> List[str]:
+    #every value below the header of one column, empty cells in between are kept as empty strings
+    letter = column_letter(column)
+    values = _call(worksheet.get, f'{letter}2:{letter}', major_dimension = 'COLUMNS')
+    return [str(value) for value in values[0]] if values else []
+
+def _cell(value) -> str:
+    if isinstance(value, list):
+        return ', '.join(str(item) for item in value)
+    return '' if value is None else str(value)
+
+class SheetWriter:
+    #writes results into the columns starting at `first_column`, rows are numbered from 0 for the first row below the header
+    def __init__(self, worksheet : Worksheet, first_column : int, rows_per_request : int = SHEETS_WRITE_ROWS):
+        self.worksheet = worksheet
+        self.first_column = first_column
+        self.rows_per_request = rows_per_request
+        self.attributes = []
+
+    def _fit(self, last_column : int, last_row : int):
+        #the values API rejects ranges which go past the grid of the sheet, so the sheet is grown first
+        if last_column > self.worksheet.col_count:
+            _call(self.worksheet.add_cols, last_column - self.worksheet.col_count)
+        if last_row > self.worksheet.row_count:
+            _call(self.worksheet.add_rows, last_row - self.worksheet.row_count)
+
+    def write_header(self, attributes : List[str]):
+        self.attributes = list(attributes)
+        if self.attributes:
+            self._fit(self.first_column + len(self.attributes) - 1, 1)
+            _call(self.worksheet.update, [self.attributes], cell_range(self.first_column, 1, self.first_column + len(self.attributes) - 1, 1))
+
+    def _ranges(self, rows : Dict[int, list]):
+        #consecutive rows are merged into one range, and no range is longer than one request
+        last_column = self.first_column + len(self.attributes) - 1
+        start, values = None, []
+        for index in sorted(rows):
+            if start is not None and (index != start + len(values) or len(values) == self.rows_per_request):
+                yield {'range' : cell_range(self.first_column, start + 2, last_column, start + 1 + len(values)), 'values' : values}
+                start, values = None, []
+            if start is None:
+                start = index
+            values.append([_cell(value) for value in rows[index]])
+        if values:
+            yield {'range' : cell_range(self.first_column, start + 2, last_column, start + 1 + len(values)), 'values' : values}
+
+    def write_rows(self, rows : Dict[int, list]):
+        #rows can be written as soon as they are found, in any order, each call sends as few batch updates as it can
+        if rows:
+            self._fit(self.first_column + len(self.attributes) - 1, max(rows) + 2)
+        request, size = [], 0
+        for value_range in self._ranges(rows):
+            if size + len(value_range['values']) > self.rows_per_request:
+                _call(self.worksheet.batch_update, request)
+                request, size = [], 0
+            request.append(value_range)
+            size += len(value_range['values'])
+        if request:
+            _call(self.worksheet.batch_update, request)
+
+    def write_records(self, column_elements : List[str], records : Dict[str, dict]):
+        #writes the records of some elements into every row where the element appears
+        rows = {index : [records[element].get(attribute, '') for attribute in self.attributes] for index, element in enumerate(column_elements) if element in records}
+        self.write_rows(rows)
+
+    def write_results(self, results : Dict[str, list]):
+        #results as returned by SearchAgent.invoke, one list of values per attribute for every row
+        self.write_header(list(results.keys()))
+        columns = list(results.values())
+        rows = {index : [column[index] for column in columns] for index in range(len(columns[0]) if columns else 0)}
+        self.write_rows(rows)
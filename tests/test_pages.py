@@ -0,0 +1,181 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+#the limits are read when the modules are imported, hence they are set first, and the page cache lives in a temporary directory
+_cache_dir = tempfile.TemporaryDirectory(prefix = 'seeker-test-pages-', ignore_cleanup_errors = True)
+os.environ.update({
+    'PAGE_FETCH_TOP_K' : '8',
+    'PAGE_FETCH_PER_DOMAIN' : '2',
+    'PAGE_TIMEOUT' : '0.5',
+    'PAGE_FETCH_DEADLINE' : '1.5',
+    'PAGE_MAX_BYTES' : '20000',
+    'PAGE_CACHE_TTL' : '0',
+    'PAGE_CACHE_PATH' : os.path.join(_cache_dir.name, 'page_cache.sqlite'),
+    'TRACE_EXPORTERS' : 'off',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pages
+from clients import run_async
+
+PAGE = b"""<html><head><script>var tracking = 1;</script></head><body><nav>Home About Careers and other menu links</nav>
+<main><p>Our headquarters address is 1 Main Street, Springfield, for all visitors.</p>
+<p>Email us at hello@acme.example or call +1 (555) 123-4567 on any weekday.</p></main></body></html>"""
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    #/page/<n> is a normal page, /slow doesn't answer within PAGE_TIMEOUT, /missing is a 404, /etag/<n> answers 304 to its own ETag,
+    #/huge sends far more than PAGE_MAX_BYTES and /trickle sends a few bytes at a time, each read well within PAGE_TIMEOUT
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            self._respond()
+        except (BrokenPipeError, ConnectionResetError): #the client stopped reading, as it should
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _html_headers(self, length : int, etag : str = None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(length))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+
+    def _respond(self):
+        if self.path.startswith('/page/'):
+            time.sleep(0.2)
+            self._html_headers(len(PAGE))
+            self.wfile.write(PAGE)
+        elif self.path == '/slow':
+            time.sleep(2)
+            self._html_headers(len(PAGE))
+            self.wfile.write(PAGE)
+        elif self.path == '/missing':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/etag/'):
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self._html_headers(len(PAGE), etag = '"v1"')
+            self.wfile.write(PAGE)
+        elif self.path == '/huge':
+            chunk = b'<p>' + b'x' * 9993 + b'</p>'
+            self._html_headers(len(chunk) * 2000)
+            for _ in range(2000):
+                self.wfile.write(chunk)
+                with self.server.lock:
+                    self.server.huge_sent += len(chunk)
+        elif self.path == '/trickle':
+            self._html_headers(100000)
+            for _ in range(100):
+                self.wfile.write(b'<p>slowly</p>')
+                self.wfile.flush()
+                time.sleep(0.1)
+
+class PageFetchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target = cls.server.serve_forever, daemon = True).start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.huge_sent = 0
+
+    def results(self, paths):
+        return {'organic_results' : [{'title' : path, 'link' : self.base + path, 'snippet' : ''} for path in paths]}
+
+    def fetch(self, paths, use_async):
+        search_results = self.results(paths)
+        query = 'email and headquarters address of Acme'
+        if use_async:
+            return run_async(pages.afetch_pages(search_results, query))
+        return pages.fetch_pages(search_results, query)
+
+    def both(self, test):
+        for use_async in [False, True]:
+            with self.subTest(use_async = use_async):
+                self.setUp()
+                test(use_async)
+
+    def test_passages_of_a_page(self):
+        def test(use_async):
+            fetched = self.fetch([f'/page/passages-{use_async}'], use_async)
+            self.assertEqual(len(fetched), 1)
+            self.assertTrue(any('hello@acme.example' in passage for passage in fetched[0]['passages']))
+            self.assertFalse(any('tracking' in passage for passage in fetched[0]['passages']))
+        self.both(test)
+
+    def test_per_domain_limit(self):
+        def test(use_async):
+            fetched = self.fetch([f'/page/limit-{use_async}-{index}' for index in range(6)], use_async)
+            self.assertEqual(len(fetched), 6)
+            self.assertEqual(self.server.max_active, 2)
+        self.both(test)
+
+    def test_timeout_and_missing_pages_are_left_out(self):
+        def test(use_async):
+            start = time.monotonic()
+            fetched = self.fetch(['/slow', '/missing', f'/page/skip-{use_async}'], use_async)
+            self.assertLess(time.monotonic() - start, 1.5)
+            self.assertEqual([page['link'] for page in fetched], [f'{self.base}/page/skip-{use_async}'])
+        self.both(test)
+
+    def test_revalidation(self):
+        def test(use_async):
+            path = f'/etag/{use_async}'
+            first = self.fetch([path], use_async)
+            time.sleep(0.01) #PAGE_CACHE_TTL is 0, the cached page is stale right away
+            second = self.fetch([path], use_async)
+            self.assertEqual(first, second)
+            self.assertEqual(len(self.server.requests), 2)
+            self.assertNotIn('If-None-Match', self.server.requests[0][1])
+            self.assertEqual(self.server.requests[1][1].get('If-None-Match'), '"v1"')
+        self.both(test)
+
+    def test_max_bytes(self):
+        def test(use_async):
+            start = time.monotonic()
+            self.fetch(['/huge'], use_async)
+            self.assertLess(time.monotonic() - start, 1.5)
+            time.sleep(0.2)
+            self.assertLess(self.server.huge_sent, 2000 * 10000 // 4) #the rest of the 20 MB was never read
+            self.assertLessEqual(len(pages.get_page_cache().get(self.base + '/huge')['text']), 20000)
+        self.both(test)
+
+    def test_deadline(self):
+        def test(use_async):
+            start = time.monotonic()
+            fetched = self.fetch(['/trickle'], use_async)
+            self.assertLess(time.monotonic() - start, 2.5)
+            self.assertEqual(fetched, [])
+        self.both(test)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from typing import List, Optional
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from dotenv import load_dotenv
+load_dotenv(dotenv_path='.env')
+
+TRACE_EXPORTERS = os.environ.get('TRACE_EXPORTERS', 'json') #a comma separated list out of json and otel, or off
+TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH', '.cache/traces.jsonl')
+TRACE_LOG_MAX_BYTES = int(os.environ.get('TRACE_LOG_MAX_BYTES', 50 * 1024 * 1024)) #the log is rotated once it grows past this
+TRACE_LOG_BACKUPS = int(os.environ.get('TRACE_LOG_BACKUPS', 3)) #rotated logs kept, as traces.jsonl.1 and so on
+
+#every run of the agent is a trace, with a span for each node it ran and for each call to SerpAPI or OpenAI made from within a node
+#nodes open their spans on the tracer of the run, calls further down (utils, the scheduler) find their parent through a context variable, which LangGraph carries into the threads and tasks it runs nodes on
+_current_span = contextvars.ContextVar('current_span', default = None)
+
+class Span:
+    def __init__(self, tracer, name : str, parent_id : Optional[str], attributes : dict):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = uuid.uuid4().hex[ : 16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self.end = None
+        self.duration = None
+        self.error = None
+        self._started = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key : str, value = 1):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def finish(self, error : Optional[BaseException] = None):
+        self.duration = time.perf_counter() - self._started
+        self.end = self.start + self.duration
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+        if self.tracer is not None:
+            self.tracer.record(self)
+
+    def to_dict(self):
+        return {
+            'trace_id' : self.tracer.trace_id if self.tracer is not None else None, 'span_id' : self.span_id, 'parent_id' : self.parent_id, 'name' : self.name,
+            'start' : self.start, 'end' : self.end, 'duration' : self.duration, 'error' : self.error, 'attributes' : self.attributes,
+        }
+
+class Tracer:
+    #collects the spans of one run, and hands them to the exporters once the run is over
+    def __init__(self, name : str = 'run', exporters : Optional[list] = None, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.exporters = get_exporters() if exporters is None else exporters
+        self.spans = []
+        self._lock = threading.Lock()
+        self.root = Span(self, name, None, attributes)
+
+    def record(self, span : Span):
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name : str, parent : Optional[Span] = None, **attributes):
+        span = Span(self, name, (parent or self.root).span_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.finish(exc)
+            raise
+        else:
+            span.finish()
+        finally:
+            _current_span.reset(token)
+
+    def finish(self, error : Optional[BaseException] = None):
+        #a run which raised is exported all the same, with the error on its root span
+        self.root.finish(error)
+        for exporter in self.exporters:
+            exporter.export(self.spans)
+        return self.summary()
+
+    def summary(self) -> dict:
+        #time per stage and calls, tokens, cache hits and retries per provider, for finding out which stage dominates latency and spend
+        stages, calls = dict(), dict()
+        for span in self.spans:
+            if span is self.root:
+                continue
+            if span.attributes.get('kind') == 'call':
+                call = calls.setdefault(span.name, {'calls' : 0, 'cache_hits' : 0, 'retries' : 0, 'prompt_tokens' : 0, 'completion_tokens' : 0, 'time' : 0.0, 'errors' : 0})
+                call['calls'] += 1
+                call['cache_hits'] += int(bool(span.attributes.get('cache_hit')))
+                for key in ['retries', 'prompt_tokens', 'completion_tokens']:
+                    call[key] += span.attributes.get(key, 0)
+                call['time'] += span.duration
+                call['errors'] += int(span.error is not None)
+            else:
+                stage = stages.setdefault(span.name, {'runs' : 0, 'time' : 0.0, 'max_time' : 0.0, 'errors' : 0})
+                stage['runs'] += 1
+                stage['time'] += span.duration
+                stage['max_time'] = max(stage['max_time'], span.duration)
+                stage['errors'] += int(span.error is not None)
+        return {'trace_id' : self.trace_id, 'wall_time' : self.root.duration, 'stages' : stages, 'calls' : calls}
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+@contextmanager
+def span(name : str, **attributes):
+    #a child of the current span, outside of a traced run it is not recorded anywhere
+    parent = current_span()
+    if parent is None or parent.tracer is None:
+        untraced = Span(None, name, None, attributes)
+        yield untraced
+        untraced.finish()
+        return
+    with parent.tracer.span(name, parent = parent, **attributes) as child:
+        yield child
+
+@contextmanager
+def call_span(provider : str, **attributes):
+    #a span for a call to an external service, the scheduler counts its retries on it
+    with span(provider, kind = 'call', cache_hit = False, retries = 0, **attributes) as call:
+        yield call
+
+def record_retry():
+    span = current_span()
+    if span is not None:
+        span.add('retries')
+
+def traced(name : str):
+    #wraps a graph node of the agent, sync or async, in a span on the tracer of the current run
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_node(self, *args, **kwargs):
+                with _node_span(self, name):
+                    return await function(self, *args, **kwargs)
+            return async_node
+
+        @functools.wraps(function)
+        def node(self, *args, **kwargs):
+            with _node_span(self, name):
+                return function(self, *args, **kwargs)
+        return node
+    return decorator
+
+def _node_span(agent, name : str):
+    tracer = getattr(agent, 'tracer', None)
+    if tracer is None:
+        return span(name, kind = 'node')
+    parent = current_span() #nested nodes such as find_llm sit under the search they were called from
+    return tracer.span(name, parent = parent if parent is not None and parent.tracer is tracer else None, kind = 'node')
+
+class JsonLogExporter:
+    #one json line per span, appended to a log file which is rotated by size, so that it never takes more than (backups + 1) * max_bytes
+    def __init__(self, path : str = TRACE_LOG_PATH, max_bytes : int = TRACE_LOG_MAX_BYTES, backups : int = TRACE_LOG_BACKUPS):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._handler = RotatingFileHandler(path, maxBytes = max_bytes, backupCount = backups, encoding = 'utf-8', delay = True)
+
+    def export(self, spans : List[Span]):
+        #the spans of a run go out as one record, hence a run is never split across two files
+        if spans:
+            lines = '\n'.join(json.dumps(span.to_dict(), default = str) for span in spans)
+            self._handler.handle(logging.makeLogRecord({'msg' : lines}))
+
+class OpenTelemetryExporter:
+    #re-creates the spans of a finished run with their original timings on an OpenTelemetry tracer, whose provider and exporter are configured by the application
+    def __init__(self, tracer = None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError('TRACE_EXPORTERS includes otel, which needs the opentelemetry-api and opentelemetry-sdk packages')
+        self.trace = trace
+        self.tracer = tracer or trace.get_tracer('seeker-agent')
+
+    def export(self, spans : List[Span]):
+        created = dict()
+        for span in sorted(spans, key = lambda span : span.start): #parents always start before their children
+            parent = created.get(span.parent_id)
+            attributes = {key : value for key, value in span.attributes.items() if isinstance(value, (str, bool, int, float))}
+            otel_span = self.tracer.start_span(span.name, context = self.trace.set_span_in_context(parent) if parent is not None else None, start_time = int(span.start * 1e9), attributes = attributes)
+            if span.error is not None:
+                otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, span.error))
+            created[span.span_id] = otel_span
+        for span in spans:
+            created[span.span_id].end(end_time = int(span.end * 1e9))
+
+_exporters = None
+_exporters_lock = threading.Lock()
+
+def get_exporters() -> list:
+    global _exporters
+    with _exporters_lock:
+        if _exporters is None:
+            factories = {'json' : JsonLogExporter, 'otel' : OpenTelemetryExporter}
+            names = [name.strip() for name in TRACE_EXPORTERS.split(',') if name.strip() and name.strip() != 'off']
+            for name in names:
+                if name not in factories:
+                    raise ValueError(f'Unknown trace exporter {name}, TRACE_EXPORTERS takes a comma separated list out of json and otel, or off')
+            _exporters = [factories[name]() for name in names]
+        return _exporters
+
+def set_exporters(exporters : list):
+    global _exporters
+    with _exporters_lock:
+        _exporters = list(exporters)
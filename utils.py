@@ -1,31 +1,118 @@
+import os
+import asyncio
+import tiktoken
+import threading
 from pydantic import BaseModel
-from openai import OpenAI
 from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+from scheduler import get_scheduler
+from tracing import call_span
+from cache import get_completion_cache, completion_key
 load_dotenv(dotenv_path='.env')
 
+SEARCH_FIELD_TOKEN_BUDGET = int(os.environ.get('SEARCH_FIELD_TOKEN_BUDGET', 120)) #per field of a search result
+SEARCH_RESULTS_TOKEN_BUDGET = int(os.environ.get('SEARCH_RESULTS_TOKEN_BUDGET', 1500)) #for the whole compacted payload
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
 def clean_search_keys(results : dict):
     filtered_dict = dict()
     for key in results.keys():
         if key not in ['search_metadata', 'search_parameters', 'search_information', 'local_map', 'inline_images', 'related_searches','dmca_messages', 'pagination', 'serpapi_pagination', 'filters', 'top_stories', 'ai_overview']:
             filtered_dict[key] = results[key]
-    
+
     return filtered_dict
 
-def find_subject_keys(json_response : str, user_query : str):
-    llm = OpenAI()
-    class Structure(BaseModel):
-        relevant_keys : list[str]
-
-    completion = llm.beta.chat.completions.parse(
-        model="gpt-4o-2024-08-06",
-        messages=[
-            {"role": "system", "content": """ Provided with a user query and a JSON file as a python dictionary,
-            provide the most relevant keys in the dictionary as per the query. """},
-            {'role' : 'user',
-            'content' : f'User query - {user_query} and dictionary response - {json_response}. Only output the relevant keys which are present in {json_response}.'}
-        ],
-        response_format=Structure,
-    )
-
-    event = completion.choices[0].message.parsed
-    return event.relevant_keys
+def _get_encoding():
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.get_encoding('o200k_base') #the encoding used by gpt-4o
+            except Exception: #the encoding is downloaded on first use, without network access token counts are estimated instead
+                _encoding = False
+        return _encoding
+
+def count_tokens(text : str) -> int:
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special = ()))
+    return (len(text) + 3) // 4
+
+def truncate_tokens(text : str, budget : int) -> str:
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special = ())
+        return text if len(tokens) <= budget else encoding.decode(tokens[ : budget]) + '...'
+    return text if len(text) <= budget * 4 else text[ : budget * 4] + '...'
+
+def _compact_fields(item : dict, keys : list, field_budget : int):
+    return {key : truncate_tokens(str(item[key]), field_budget) for key in keys if item.get(key) not in [None, '', [], {}]}
+
+def compact_search_results(results : dict, field_budget : int = SEARCH_FIELD_TOKEN_BUDGET, total_budget : int = SEARCH_RESULTS_TOKEN_BUDGET):
+    #keeps only the parts of the search results which carry content, each field and the payload as a whole are capped in tokens
+    results = clean_search_keys(results)
+    compacted = dict()
+    if isinstance(results.get('answer_box'), dict):
+        compacted['answer_box'] = _compact_fields(results['answer_box'], ['title', 'answer', 'result', 'snippet', 'list', 'link'], field_budget)
+    if isinstance(results.get('knowledge_graph'), dict):
+        #knowledge graph facts are the plain string values, links to images, thumbnails and other searches are left out
+        facts = [key for key, value in results['knowledge_graph'].items() if isinstance(value, str) and not value.startswith('http') and not key.endswith(('_link', '_links', 'kgmid', 'image', 'thumbnail'))]
+        compacted['knowledge_graph'] = _compact_fields(results['knowledge_graph'], facts + ['website'], field_budget)
+    places = results.get('local_results', {})
+    places = places.get('places', []) if isinstance(places, dict) else places
+    if places:
+        compacted['local_results'] = [_compact_fields(place, ['title', 'address', 'phone', 'website', 'description'], field_budget) for place in places[ : 3] if isinstance(place, dict)]
+    compacted['organic_results'] = []
+    used = count_tokens(str(compacted))
+    for result in results.get('organic_results', []):
+        item = _compact_fields(result, ['title', 'snippet', 'link'], field_budget)
+        cost = count_tokens(str(item))
+        if used + cost > total_budget:
+            break
+        compacted['organic_results'].append(item)
+        used += cost
+
+    return {key : value for key, value in compacted.items() if value}
+
+def _completion_request(llm, model : str, messages : list, response_format = None):
+    #picks the endpoint for the response format, works for both OpenAI and AsyncOpenAI since the two share their interface
+    if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+        return llm.beta.chat.completions.parse(model = model, messages = messages, response_format = response_format)
+    elif response_format is not None:
+        return llm.chat.completions.create(model = model, messages = messages, response_format = response_format)
+    return llm.chat.completions.create(model = model, messages = messages)
+
+def _cache_completion(cache, key : str, completion, call, check = None) -> str:
+    if getattr(completion, 'usage', None) is not None:
+        call.set(prompt_tokens = completion.usage.prompt_tokens, completion_tokens = completion.usage.completion_tokens)
+    content = completion.choices[0].message.content
+    if check is not None and content is not None:
+        check(content) #raises for a completion the caller can't use, which is then not cached so that a retry gets a fresh one
+    if cache is not None and content is not None and completion.choices[0].finish_reason == 'stop': #truncated or refused completions are not cached
+        cache.set(key, content)
+    return content
+
+def chat_completion(llm : OpenAI, model : str, messages : list, response_format = None, check = None) -> str:
+    #every completion goes through here, the prompts are deterministic given their inputs so identical requests are served from the cache
+    cache = get_completion_cache()
+    key = completion_key(model, messages, response_format)
+    with call_span('openai', model = model) as call:
+        content = cache.get(key) if cache is not None else None
+        if content is not None:
+            call.set(cache_hit = True)
+            return content
+        return _cache_completion(cache, key, get_scheduler().call('openai', _completion_request, llm, model, messages, response_format), call, check)
+
+async def achat_completion(llm : AsyncOpenAI, model : str, messages : list, response_format = None, check = None) -> str:
+    #the cache can be on disk, hence it is read and written in a worker thread rather than on the shared event loop
+    cache = await asyncio.to_thread(get_completion_cache)
+    key = completion_key(model, messages, response_format)
+    with call_span('openai', model = model) as call:
+        content = await asyncio.to_thread(cache.get, key) if cache is not None else None
+        if content is not None:
+            call.set(cache_hit = True)
+            return content
+        completion = await get_scheduler().acall('openai', _completion_request, llm, model, messages, response_format)
+        return await asyncio.to_thread(_cache_completion, cache, key, completion, call, check)